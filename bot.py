@@ -10,17 +10,23 @@ import random
 import shutil
 import subprocess
 import contextlib
+import contextvars
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from telethon import TelegramClient, events
 import telethon.errors
-from telethon.tl.types import User, Chat, Channel
+from telethon.tl.types import User, Chat, Channel, InputDocument, InputMediaUploadedDocument, DocumentAttributeVideo
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QScrollArea, QTextBrowser, QComboBox,
                                QLabel, QLineEdit, QPushButton, QDialog, QProgressBar, QMessageBox, QFileDialog, QMenu, QMenuBar,
                                QListWidget, QListWidgetItem, QRadioButton, QGroupBox, QTabWidget, QGraphicsDropShadowEffect)
-from PySide6.QtCore import Qt, QTimer, QRegularExpression, Signal, QPropertyAnimation, QRect, QUrl, QThread
+from PySide6.QtCore import Qt, QTimer, QRegularExpression, Signal, QPropertyAnimation, QRect, QUrl, QThread, QObject
 from PySide6.QtGui import QRegularExpressionValidator, QColor, QDesktopServices, QCursor, QIcon, QAction, QGuiApplication
 from qasync import QEventLoop, asyncSlot
 import yt_dlp
+from ytdlp_worker import run_ytdlp, YtdlpDownloadError
+from video_links import scan_video_links
 import json
 import base64
 import requests
@@ -58,14 +64,44 @@ def get_current_version():
         return "0.0.0"  # Резервная версия для новой установки
 
 CURRENT_VERSION = get_current_version()
-VIDEO_URL_PATTERNS = {
-    'youtube': re.compile(r'(?:https?://)?(?:www\.)?(?:youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/)([\w-]{11})'),
-    'instagram': re.compile(r'(?:https?://)?(?:www\.)?instagram\.com/reel[s]?/([\w-]+)'),
-    'tiktok': re.compile(r'(?:https?://)?(?:[\w-]+\.)?tiktok\.com/(?:@([\w\.-]+)/video/|v/)?([\w-]+)'),
-    'twitter': re.compile(r'(?:https?://)?(?:www\.)?(?:twitter\.com|x\.com)/[\w-]+/status/(\d+)')
-}
 TEMP_DIR = "temp-files"
 os.makedirs(TEMP_DIR, exist_ok=True)
+# Кэш готовых для Telegram видео: переживает перезапуск, размер ограничен настройкой, вытесняются давно не использованные
+VIDEO_CACHE_DIR = "video-cache"
+os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+DEFAULT_VIDEO_CACHE_MB = 2048
+VIDEO_CACHE_SIZES_MB = (0, 512, 1024, 2048, 5120, 10240)
+YOUTUBE_MAX_DURATION = 180  # Более длинные видео YouTube отклоняются, сек
+# Кэш метаданных YouTube: длительность не меняется, а недоступность бывает временной
+VIDEO_METADATA_TTL = 7 * 24 * 3600
+VIDEO_METADATA_NEGATIVE_TTL = 3600
+VIDEO_ENCODE_PROFILE = "h264-baseline-720p-1000k"  # Менять вместе с параметрами ffmpeg, чтобы не отдавать файлы старого формата
+DEFAULT_WORKER_COUNT = 5  # Количество параллельных обработчиков очереди по умолчанию
+MAX_WORKER_COUNT = 10
+REWRITE_WORKER_COUNT = 5  # Перезапись ссылок почти мгновенна, поэтому у неё свой лимит
+# Очереди задач: быстрая перезапись ссылок и тяжёлая загрузка с конвертацией
+TASK_LANES = ('rewrite', 'media')
+PLATFORM_LANES = {'youtube': 'media', 'instagram': 'rewrite', 'tiktok': 'rewrite', 'twitter': 'rewrite'}
+TASK_TIMEOUT = 300  # Тайм-аут одной задачи перезаписи ссылок, сек
+STAGE_TIMEOUT = 300  # Тайм-аут работы в одной стадии конвейера видео, сек; ожидание места в стадии не считается
+ENTITY_CACHE_TTL = 600  # Сколько хранить сущности чатов и отправителей, сек
+JOB_REPLAY_BATCH_SIZE = 100  # Сообщений за один запрос get_messages при восстановлении очереди
+CLAIM_WINDOW = 5  # Сколько ждать ответа другого бота на ту же ссылку после нашего ответа, сек
+SIGNATURE_INDEX_SIZE = 5000  # Сколько последних чужих подписей хранить
+RECENT_MESSAGES_PER_CHAT = 3  # Сколько последних сообщений чата проверять на ссылку, уже обработанную другим ботом
+# Случайная задержка перед обработкой чужой ссылки нужна только в чатах, где недавно отвечали другие боты.
+# Окно в днях, 0 — ждать всегда
+DEFAULT_COMPETITOR_WINDOW_DAYS = 30
+COMPETITOR_WINDOWS_DAYS = (0, 1, 7, 30, 90)
+BOT_SIGNATURE_PATTERN = re.compile(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]')
+# Конвейер YouTube: метаданные → загрузка → конвертация → выгрузка, у каждой стадии свой лимит
+METADATA_CONCURRENCY = 4
+UPLOAD_CONCURRENCY = 2
+FFMPEG_THREADS_PER_ENCODE = 2  # Потоков libx264 на одну конвертацию
+PIPELINE_QUEUE_SIZE = 2  # Сколько задач может ждать между стадиями сверх их лимитов
+# В пуле yt-dlp хватает мест на стадии метаданных и загрузки одновременно: иначе вызов ждал бы
+# свободного потока внутри пула, пока уже идёт тайм-аут стадии
+YTDLP_EXECUTOR_WORKERS = METADATA_CONCURRENCY + MAX_WORKER_COUNT
 
 async def run_with_timeout(coro, timeout):
     try:
@@ -122,6 +158,47 @@ def init_db():
                         key TEXT PRIMARY KEY,
                         value INTEGER
                       )''')
+    # Очередь задач, переживающая перезапуск: хранятся только координаты сообщения и ссылка
+    cursor.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        chat_id INTEGER,
+                        message_id INTEGER,
+                        url TEXT,
+                        created_at REAL,
+                        PRIMARY KEY (chat_id, message_id)
+                      )''')
+    # Результаты проверки видео (длительность, доступность), чтобы повторные ссылки не запрашивали YouTube заново
+    cursor.execute('''CREATE TABLE IF NOT EXISTS video_metadata (
+                        platform TEXT,
+                        video_id TEXT,
+                        available INTEGER,
+                        duration INTEGER,
+                        title TEXT,
+                        format_id TEXT,
+                        width INTEGER,
+                        height INTEGER,
+                        checked_at REAL,
+                        PRIMARY KEY (platform, video_id)
+                      )''')
+    # Видео, уже загруженные в Telegram: повторная отправка по ссылке на документ без загрузки и конвертации
+    cursor.execute('''CREATE TABLE IF NOT EXISTS media_cache (
+                        platform TEXT,
+                        video_id TEXT,
+                        profile TEXT,
+                        document_id INTEGER,
+                        access_hash INTEGER,
+                        file_reference BLOB,
+                        duration INTEGER,
+                        width INTEGER,
+                        height INTEGER,
+                        uploaded_at REAL,
+                        PRIMARY KEY (platform, video_id, profile)
+                      )''')
+    # Когда в чате последний раз отвечал другой бот: по этим данным решается, нужна ли задержка перед обработкой
+    cursor.execute('''CREATE TABLE IF NOT EXISTS competitor_sightings (
+                        chat_id INTEGER PRIMARY KEY,
+                        sightings INTEGER,
+                        last_seen REAL
+                      )''')
     # Новая таблица для пресетов ByeDPI
     cursor.execute('''CREATE TABLE IF NOT EXISTS byedpi_presets (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -144,6 +221,40 @@ def init_db():
     conn.commit()
     conn.close()
 
+# Настройки, которые читаются на каждое сообщение и каждую задачу, держим в памяти.
+# Раздел загружается из БД при первом чтении, save_* функции пишут в БД и перезагружают свой раздел,
+# после чего changed сообщает окнам и обработчику сообщений, что раздел изменился.
+# Разделы: 'selected_chats' — tuple[(chat_id, title, type)], 'platforms' — dict[str, bool],
+# 'responses' — tuple[(id, text)], 'byedpi_presets' — tuple[dict],
+# 'selected_chat_ids' — frozenset нормализованных id выбранных чатов (вычисляется из 'selected_chats')
+class SettingsStore(QObject):
+    changed = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.sections = {}
+        self.loaders = {}
+        self.dependents = {}  # {раздел: [производные разделы]}
+
+    def register(self, section, loader, depends_on=None):
+        self.loaders[section] = loader
+        if depends_on is not None:
+            self.dependents.setdefault(depends_on, []).append(section)
+
+    def get(self, section):
+        if section not in self.sections:
+            self.sections[section] = self.loaders[section]()
+        return self.sections[section]
+
+    def reload(self, section):
+        self.sections[section] = self.loaders[section]()
+        # Производные разделы пересчитываются при следующем чтении
+        for dependent in self.dependents.get(section, ()):
+            self.sections.pop(dependent, None)
+        self.changed.emit(section)
+
+settings_store = SettingsStore()
+
 # Функции работы с БД
 def get_auth_data():
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -198,6 +309,7 @@ def save_selected_chat(chat_id, title, chat_type):
                    (chat_id, title, chat_type, datetime.now().isoformat()))
     conn.commit()
     conn.close()
+    settings_store.reload('selected_chats')
 
 def remove_selected_chat(chat_id):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -205,14 +317,30 @@ def remove_selected_chat(chat_id):
     cursor.execute("DELETE FROM selected_chats WHERE chat_id = ?", (chat_id,))
     conn.commit()
     conn.close()
+    settings_store.reload('selected_chats')
 
-def get_selected_chats():
+def clear_selected_chats():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM selected_chats")
+    conn.commit()
+    conn.close()
+    settings_store.reload('selected_chats')
+
+def load_selected_chats():
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
     cursor.execute("SELECT chat_id, title, type FROM selected_chats")
     data = cursor.fetchall()
     conn.close()
-    return data
+    return tuple(data)
+
+def get_selected_chats():
+    return settings_store.get('selected_chats')
+
+def get_selected_chat_ids():
+    # Множество для проверки чата входящего сообщения без запросов к БД и преобразований строк
+    return settings_store.get('selected_chat_ids')
 
 def save_platform_setting(platform, enabled):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -220,8 +348,9 @@ def save_platform_setting(platform, enabled):
     cursor.execute("INSERT OR REPLACE INTO platform_settings (platform, enabled) VALUES (?, ?)", (platform, 1 if enabled else 0))
     conn.commit()
     conn.close()
+    settings_store.reload('platforms')
 
-def get_platform_settings():
+def read_platform_settings_from_db():
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
     cursor.execute("SELECT platform, enabled FROM platform_settings")
@@ -229,20 +358,28 @@ def get_platform_settings():
     conn.close()
     return {platform: bool(enabled) for platform, enabled in data}
 
+def get_platform_settings():
+    # Копия, чтобы вызывающий код не мог случайно изменить общий кэш
+    return dict(settings_store.get('platforms'))
+
 def save_response(text):
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
     cursor.execute("INSERT INTO responses (text) VALUES (?)", (text,))
     conn.commit()
     conn.close()
+    settings_store.reload('responses')
 
-def get_responses():
+def load_responses():
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
     cursor.execute("SELECT id, text FROM responses ORDER BY id")
     data = cursor.fetchall()
     conn.close()
-    return data
+    return tuple(data)
+
+def get_responses():
+    return settings_store.get('responses')
 
 def delete_response(response_id):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -250,6 +387,7 @@ def delete_response(response_id):
     cursor.execute("DELETE FROM responses WHERE id = ?", (response_id,))
     conn.commit()
     conn.close()
+    settings_store.reload('responses')
 
 def clear_responses():
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -257,6 +395,7 @@ def clear_responses():
     cursor.execute("DELETE FROM responses")
     conn.commit()
     conn.close()
+    settings_store.reload('responses')
 
 def update_response(response_id, text):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -264,6 +403,7 @@ def update_response(response_id, text):
     cursor.execute("UPDATE responses SET text = ? WHERE id = ?", (text, response_id))
     conn.commit()
     conn.close()
+    settings_store.reload('responses')
 
 def save_user(user_id, username, first_name, last_name):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -319,6 +459,160 @@ def get_only_me_mode():
     conn.close()
     return bool(result[0]) if result else False
 
+def get_worker_count():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", ('worker_count',))
+    result = cursor.fetchone()
+    conn.close()
+    return min(max(int(result[0]), 1), MAX_WORKER_COUNT) if result else DEFAULT_WORKER_COUNT
+
+def save_worker_count(count):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('worker_count', int(count)))
+    conn.commit()
+    conn.close()
+
+def get_video_cache_mb():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", ('video_cache_mb',))
+    result = cursor.fetchone()
+    conn.close()
+    return max(int(result[0]), 0) if result else DEFAULT_VIDEO_CACHE_MB
+
+def save_video_cache_mb(size_mb):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('video_cache_mb', int(size_mb)))
+    conn.commit()
+    conn.close()
+
+def get_competitor_window_days():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", ('competitor_window_days',))
+    result = cursor.fetchone()
+    conn.close()
+    return max(int(result[0]), 0) if result else DEFAULT_COMPETITOR_WINDOW_DAYS
+
+def save_competitor_window_days(days):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('competitor_window_days', int(days)))
+    conn.commit()
+    conn.close()
+
+def get_competitor_last_seen():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, last_seen FROM competitor_sightings")
+    result = dict(cursor.fetchall())
+    conn.close()
+    return result
+
+def write_competitor_sightings(sightings):
+    # sightings: [(chat_id, новых появлений, last_seen)] — одной транзакцией
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO competitor_sightings (chat_id, sightings, last_seen) VALUES (?, ?, ?) "
+                       "ON CONFLICT(chat_id) DO UPDATE SET sightings = sightings + excluded.sightings, last_seen = excluded.last_seen",
+                       sightings)
+    conn.commit()
+    conn.close()
+
+def get_ytdlp_process_pool():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", ('ytdlp_process_pool',))
+    result = cursor.fetchone()
+    conn.close()
+    return bool(result[0]) if result else False
+
+def save_ytdlp_process_pool(enabled):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('ytdlp_process_pool', 1 if enabled else 0))
+    conn.commit()
+    conn.close()
+
+def write_jobs(saved_jobs, deleted_jobs):
+    # Групповая запись: все накопленные изменения очереди одной транзакцией
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM jobs WHERE chat_id = ? AND message_id = ?", deleted_jobs)
+    cursor.executemany("INSERT OR REPLACE INTO jobs (chat_id, message_id, url, created_at) VALUES (?, ?, ?, ?)", saved_jobs)
+    conn.commit()
+    conn.close()
+
+def get_saved_jobs():
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, message_id, url, created_at FROM jobs ORDER BY created_at")
+    jobs = cursor.fetchall()
+    conn.close()
+    return jobs
+
+def get_video_metadata(link_key):
+    # Возвращает метаданные, если срок их хранения не истёк: для недоступных видео он короче
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT available, duration, title, format_id, width, height, checked_at FROM video_metadata WHERE platform = ? AND video_id = ?",
+                   (link_key[0], link_key[1]))
+    result = cursor.fetchone()
+    conn.close()
+    if not result:
+        return None
+    available, duration, title, format_id, width, height, checked_at = result
+    if time.time() - checked_at > (VIDEO_METADATA_TTL if available else VIDEO_METADATA_NEGATIVE_TTL):
+        return None
+    return {'available': bool(available), 'duration': duration, 'title': title, 'format_id': format_id, 'width': width, 'height': height}
+
+def save_video_metadata(link_key, info):
+    # info = None — видео недоступно
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    if info is None:
+        row = (link_key[0], link_key[1], 0, None, None, None, None, None, time.time())
+    else:
+        row = (link_key[0], link_key[1], 1, int(info.get('duration') or 0), info.get('title'), info.get('format_id'),
+               info.get('width'), info.get('height'), time.time())
+    cursor.execute("INSERT OR REPLACE INTO video_metadata (platform, video_id, available, duration, title, format_id, width, height, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+    conn.commit()
+    conn.close()
+
+def get_cached_media(link_key, profile):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("SELECT document_id, access_hash, file_reference, duration, width, height FROM media_cache WHERE platform = ? AND video_id = ? AND profile = ?",
+                   (link_key[0], link_key[1], profile))
+    result = cursor.fetchone()
+    conn.close()
+    if not result:
+        return None
+    document_id, access_hash, file_reference, duration, width, height = result
+    return {
+        'document': InputDocument(id=document_id, access_hash=access_hash, file_reference=file_reference),
+        'info': {'duration': duration, 'width': width, 'height': height},
+    }
+
+def save_cached_media(link_key, profile, document, info):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO media_cache (platform, video_id, profile, document_id, access_hash, file_reference, duration, width, height, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (link_key[0], link_key[1], profile, document.id, document.access_hash, document.file_reference,
+                    int(info.get('duration') or 0), info.get('width'), info.get('height'), time.time()))
+    conn.commit()
+    conn.close()
+
+def delete_cached_media(link_key, profile):
+    conn = sqlite3.connect('telegram_bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM media_cache WHERE platform = ? AND video_id = ? AND profile = ?", (link_key[0], link_key[1], profile))
+    conn.commit()
+    conn.close()
+
 def get_remember_me():
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
@@ -343,12 +637,8 @@ def check_selected_chats():
     return count > 0
 
 def get_byedpi_enabled():
-    conn = sqlite3.connect('telegram_bot_data.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT enabled FROM platform_settings WHERE platform = ?", ('byedpi_enabled',))
-    result = cursor.fetchone()
-    conn.close()
-    return bool(result[0]) if result else False
+    # Флаг хранится в таблице platform_settings, поэтому читается из того же раздела кэша
+    return settings_store.get('platforms').get('byedpi_enabled', False)
 
 def save_byedpi_enabled(enabled):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -357,14 +647,18 @@ def save_byedpi_enabled(enabled):
                    ('byedpi_enabled', 1 if enabled else 0))
     conn.commit()
     conn.close()
+    settings_store.reload('platforms')
 
-def get_byedpi_presets():
+def read_byedpi_presets_from_db():
     conn = sqlite3.connect('telegram_bot_data.db')
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, port, params FROM byedpi_presets ORDER BY id")
     data = cursor.fetchall()
     conn.close()
-    return [{'id': row[0], 'name': row[1], 'port': row[2], 'params': row[3]} for row in data]
+    return tuple({'id': row[0], 'name': row[1], 'port': row[2], 'params': row[3]} for row in data)
+
+def get_byedpi_presets():
+    return settings_store.get('byedpi_presets')
 
 def save_byedpi_preset(name, port, params):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -372,6 +666,7 @@ def save_byedpi_preset(name, port, params):
     cursor.execute("INSERT INTO byedpi_presets (name, port, params) VALUES (?, ?, ?)", (name, port, params))
     conn.commit()
     conn.close()
+    settings_store.reload('byedpi_presets')
 
 def delete_byedpi_preset(preset_id):
     conn = sqlite3.connect('telegram_bot_data.db')
@@ -379,6 +674,13 @@ def delete_byedpi_preset(preset_id):
     cursor.execute("DELETE FROM byedpi_presets WHERE id = ? AND name != 'Default'", (preset_id,))
     conn.commit()
     conn.close()
+    settings_store.reload('byedpi_presets')
+
+settings_store.register('selected_chats', load_selected_chats)
+settings_store.register('selected_chat_ids', lambda: frozenset(normalize_chat_id(chat_id) for chat_id, _, _ in get_selected_chats()), depends_on='selected_chats')
+settings_store.register('platforms', read_platform_settings_from_db)
+settings_store.register('responses', load_responses)
+settings_store.register('byedpi_presets', read_byedpi_presets_from_db)
 
 class DownloadThread(QThread):
     progress = Signal(int)
@@ -442,6 +744,544 @@ class DownloadThread(QThread):
                 if response is not None:
                     response.close()  # Явно закрываем соединение
 
+def normalize_chat_id(chat_id):
+    if str(chat_id).startswith('-100'):
+        return int(str(chat_id)[4:])
+    return abs(chat_id)
+
+def get_rewritten_url(platform, video_id, url):
+    # Ссылка на сервис, который показывает видео прямо в Telegram
+    if platform == 'instagram':
+        return f"https://www.ddinstagram.com/reel/{video_id}/"
+    if platform == 'tiktok':
+        return url.replace('.tiktok.com', '.vxtiktok.com').replace('vm.tiktok.com', 'vm.vxtiktok.com').replace('vt.tiktok.com', 'vm.vxtiktok.com')
+    return re.sub(r'^(https?://)(?:www\.)?(?:x|twitter)\.com', r'\1fxtwitter.com', url)
+
+def get_link_key(text):
+    # Каноничный ключ первой ссылки (платформа, id видео) для дедупликации задач
+    links = scan_video_links(text)
+    return links[0][:2] if links else None
+
+def format_chat_title(entity):
+    return entity.title if hasattr(entity, 'title') else f"{entity.first_name or ''} {entity.last_name or ''}".strip()
+
+def format_sender_info(sender):
+    if sender is None:
+        return "для неизвестного пользователя"
+    return f"для @{getattr(sender, 'username', None) or ''} {getattr(sender, 'first_name', None) or ''} {getattr(sender, 'last_name', None) or ''}".strip()
+
+# TTL-кэш сущностей чатов и подписей отправителей для обработки ссылок: одна ссылка проходит
+# message_handler, process_video_link и process_video, и без кэша каждый шаг заново запрашивает их у Telegram.
+# Ошибки не кэшируются: вызывающий код сам решает, что подставить вместо названия
+class EntityCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.chats = {}  # {chat_id: (entity, chat_title, expires_at)}
+        self.senders = {}  # {sender_id: (sender_info, expires_at)}
+
+    async def get_chat(self, chat_id):
+        # Возвращает (entity, chat_title)
+        cached = self.chats.get(chat_id)
+        if cached is not None and cached[2] > time.time():
+            return cached[0], cached[1]
+        entity = await state.client.get_entity(chat_id)
+        chat_title = format_chat_title(entity)
+        self.chats[chat_id] = (entity, chat_title, time.time() + self.ttl)
+        return entity, chat_title
+
+    async def get_sender_info(self, message):
+        cached = self.senders.get(message.sender_id)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        # Отправитель обычно уже пришёл вместе с обновлением, тогда get_sender обходится без запроса
+        sender = await message.get_sender()
+        sender_info = format_sender_info(sender)
+        if sender is None:
+            # Отправителя не удалось получить — заглушку не кэшируем, в следующий раз он может найтись
+            return sender_info
+        self.senders[message.sender_id] = (sender_info, time.time() + self.ttl)
+        return sender_info
+
+    def peek_chat_title(self, chat_id):
+        # Только из кэша, без запросов к Telegram
+        cached = self.chats.get(chat_id)
+        return cached[1] if cached is not None else str(chat_id)
+
+    def peek_sender_info(self, sender_id):
+        cached = self.senders.get(sender_id)
+        return cached[0] if cached is not None else "для неизвестного пользователя"
+
+    def invalidate_chat(self, chat_id):
+        self.chats.pop(chat_id, None)
+
+    def invalidate_sender(self, sender_id):
+        self.senders.pop(sender_id, None)
+
+    def clear(self):
+        self.chats.clear()
+        self.senders.clear()
+
+PLATFORM_LABELS = {"youtube": "YouTube 📺", "tiktok": "TikTok 🎵", "twitter": "Twitter 🐦", "instagram": "Instagram 📸"}
+# Подписи платформ в ответах бота и названия в журнале
+MESSAGE_PLATFORM_LABELS = {"youtube": "YouTube 📺", "tiktok": "TikTok 🎵", "twitter": "Twitter (X) 🐦", "instagram": "Instagram 📸"}
+PLATFORM_LOG_NAMES = {"youtube": "YouTube", "tiktok": "TikTok", "twitter": "Twitter", "instagram": "Instagram"}
+JOB_STAGE_LABELS = {'pending': '🔎 Проверка', 'queued': '⏳ Ожидание', 'running': '🎥 Обработка'}
+
+# Запись о задаче обработки ссылки. Это же контекст обработки: всё, что нужно про чат и сообщение,
+# вычисляется один раз при постановке в очередь и дальше только читается
+class Job:
+    __slots__ = ('id', 'chat_id', 'message_id', 'text', 'message', 'platform', 'video_id', 'lane',
+                 'stage', 'created_at', 'started_at', 'task', 'chat_title', 'sender_info', 'prefetch',
+                 'is_forwarded', 'can_edit', 'links')
+
+    def __init__(self, chat_id, message, text, links, chat_title, sender_info):
+        self.id = str(uuid.uuid4())
+        self.chat_id = chat_id
+        self.message_id = message.id
+        self.text = text
+        self.message = message
+        self.links = links  # Результат scan_video_links(text): текст разбирается один раз на задачу
+        self.platform, self.video_id = links[0][:2]
+        # Задача обрабатывает все ссылки сообщения: одно видео YouTube среди них — и она идёт в очередь загрузки
+        self.lane = 'media' if any(PLATFORM_LANES.get(link[0], 'media') == 'media' for link in links) else 'rewrite'
+        self.stage = 'pending'
+        self.created_at = time.time()
+        self.started_at = None
+        self.task = None
+        self.chat_title = chat_title
+        self.sender_info = sender_info
+        self.prefetch = None  # Задача опережающего получения метаданных (только YouTube)
+        self.is_forwarded = message.fwd_from is not None
+        self.can_edit = False  # Заполняется в build_job_context
+
+    @property
+    def key(self):
+        # Одна и та же ссылка в разных чатах — разные задачи, общую работу объединяет MediaFlight
+        return normalize_chat_id(self.chat_id), self.platform, self.video_id
+
+def get_can_edit(chat_entity, message):
+    # Можно ли отредактировать исходное сообщение вместо ответа на него
+    is_forwarded = message.fwd_from is not None
+    is_own_message = message.sender_id == state.current_user_id
+    if isinstance(chat_entity, Channel):
+        # Для каналов и супергрупп
+        if chat_entity.megagroup:
+            # Для супергрупп используем старую логику, если нет прав на редактирование
+            can_edit = is_own_message and not is_forwarded
+            if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
+                if chat_entity.admin_rights.edit_messages:
+                    can_edit = not is_forwarded  # Если есть права, игнорируем is_own_message
+            return can_edit
+        # Для обычных каналов проверяем права
+        if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
+            return chat_entity.admin_rights.edit_messages and not is_forwarded
+        return False  # Если нет прав админа, редактировать нельзя
+    # Для личных переписок и групп (и если чат получить не удалось) используем старую логику
+    return is_own_message and not is_forwarded
+
+async def build_job_context(job):
+    try:
+        chat_entity, job.chat_title = await state.entities.get_chat(job.chat_id)
+    except Exception as e:
+        logging.error(f"Не удалось проверить права на редактирование для чата {job.chat_id}: {str(e)}", extra={'chat_title': job.chat_title, 'sender_info': job.sender_info})
+        chat_entity = None
+    job.can_edit = get_can_edit(chat_entity, job.message)
+
+# Подписи других ботов из потока обновлений: {(normalized_chat_id, id сообщения со ссылкой): подпись}.
+# Заменяет опрос get_messages: чужой ответ на ссылку виден, как только приходит событие
+class SignatureIndex:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.claims = collections.OrderedDict()
+        self.waiters = {}  # {ключ: [Future]} — задачи, ждущие чужого ответа на своё сообщение
+
+    def add(self, chat_id, message_id, signature):
+        key = (normalize_chat_id(chat_id), message_id)
+        self.claims[key] = signature
+        self.claims.move_to_end(key)
+        while len(self.claims) > self.max_size:
+            self.claims.popitem(last=False)
+        for future in self.waiters.pop(key, ()):
+            if not future.done():
+                future.set_result(signature)
+
+    def get(self, chat_id, message_id):
+        return self.claims.get((normalize_chat_id(chat_id), message_id))
+
+    async def wait(self, chat_id, message_id, timeout):
+        # Подпись другого бота или None, если за timeout секунд никто не ответил
+        signature = self.get(chat_id, message_id)
+        if signature is not None:
+            return signature
+        key = (normalize_chat_id(chat_id), message_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.waiters.get(key)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.waiters[key]
+
+# Последние сообщения каждого чата из потока обновлений: ссылки и подпись бота разобраны заранее,
+# поэтому проверка «ссылку уже обработал другой бот» обходится без get_messages
+class RecentMessages:
+    def __init__(self, size):
+        self.size = size
+        self.chats = {}  # {normalized_chat_id: deque[(id сообщения, {(платформа, id видео)}, подпись или None)]}
+
+    @staticmethod
+    def parse(message_id, text):
+        match = BOT_SIGNATURE_PATTERN.search(text) if '[BotSignature:' in text else None
+        return message_id, frozenset(link[:2] for link in scan_video_links(text)), match.group(1) if match else None
+
+    def add(self, chat_id, message_id, text):
+        chat_key = normalize_chat_id(chat_id)
+        messages = self.chats.get(chat_key)
+        if messages is None:
+            messages = self.chats[chat_key] = collections.deque(maxlen=self.size)
+        messages.append(self.parse(message_id, text))
+
+    def update(self, chat_id, message_id, text):
+        # Правка учитывается, только если сообщение ещё среди последних
+        messages = self.chats.get(normalize_chat_id(chat_id), ())
+        for index, entry in enumerate(messages):
+            if entry[0] == message_id:
+                messages[index] = self.parse(message_id, text)
+                break
+
+    def find_foreign_claim(self, chat_id, link_keys):
+        # Подпись другого бота в недавнем сообщении с любой из этих ссылок, иначе None
+        for _, message_links, signature in self.chats.get(normalize_chat_id(chat_id), ()):
+            if signature is not None and signature != state.bot_signature_id and not message_links.isdisjoint(link_keys):
+                return signature
+        return None
+
+    def clear(self):
+        self.chats.clear()
+
+async def on_chat_event(event):
+    # NewMessage и MessageEdited выбранных чатов: только разбор текста, без запросов к Telegram
+    message = event.message
+    text = message.text or ""
+    if isinstance(event, events.MessageEdited.Event):
+        state.recent_messages.update(event.chat_id, message.id, text)
+    else:
+        state.recent_messages.add(event.chat_id, message.id, text)
+    if '[BotSignature:' not in text:
+        return
+    match = BOT_SIGNATURE_PATTERN.search(text)
+    if match is None or match.group(1) == state.bot_signature_id:
+        return
+    # Ответ другого бота относится к сообщению со ссылкой, правка — к самому сообщению
+    claimed_message_id = message.reply_to_msg_id or message.id
+    signature = match.group(1)
+    if state.signatures.get(event.chat_id, claimed_message_id) == signature:
+        # Правки прогресса того же ответа — не новое появление бота
+        return
+    state.signatures.add(event.chat_id, claimed_message_id, signature)
+    record_competitor_sighting(event.chat_id)
+
+# Появления других ботов: память обновляется сразу, SQLite — пачкой вместе с очередью задач в flush_job_journal
+def record_competitor_sighting(chat_id):
+    normalized_chat_id = normalize_chat_id(chat_id)
+    seen_at = time.time()
+    state.competitor_last_seen[normalized_chat_id] = seen_at
+    pending = state.competitor_journal.get(normalized_chat_id)
+    state.competitor_journal[normalized_chat_id] = ((pending[0] if pending else 0) + 1, seen_at)
+
+def flush_competitor_journal():
+    if not state.competitor_journal:
+        return
+    journal, state.competitor_journal = state.competitor_journal, {}
+    try:
+        write_competitor_sightings([(chat_id, count, seen_at) for chat_id, (count, seen_at) in journal.items()])
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить статистику других ботов: {str(e)}")
+        for chat_id, (count, seen_at) in state.competitor_journal.items():
+            pending = journal.get(chat_id)
+            journal[chat_id] = ((pending[0] if pending else 0) + count, seen_at)
+        state.competitor_journal = journal
+
+def is_chat_contested(chat_id):
+    # В чате недавно отвечал другой бот — ссылкам нужна случайная задержка, чтобы не обрабатывать их дважды
+    if not state.competitor_window_days:
+        return True
+    last_seen = state.competitor_last_seen.get(normalize_chat_id(chat_id))
+    return last_seen is not None and time.time() - last_seen < state.competitor_window_days * 86400
+
+# Таблица задач: поиск по id и дедупликация по (чат, платформа, id видео) за O(1)
+class JobRegistry:
+    def __init__(self):
+        self.jobs = {}  # {job_id: Job}, порядок добавления сохраняется
+        self.by_key = {}  # {Job.key: Job} — ключ (нормализованный chat_id, платформа, id видео)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(list(self.jobs.values()))
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def find(self, chat_id, link_key):
+        if link_key is None:
+            return None
+        return self.by_key.get((normalize_chat_id(chat_id), *link_key))
+
+    def add(self, job):
+        self.jobs[job.id] = job
+        self.by_key[job.key] = job
+
+    def remove(self, job):
+        self.jobs.pop(job.id, None)
+        if self.by_key.get(job.key) is job:
+            del self.by_key[job.key]
+
+    def with_stage(self, stage):
+        return [job for job in self.jobs.values() if job.stage == stage]
+
+# Очередь с поочерёдной выдачей задач по чатам (round-robin по normalized_chat_id),
+# чтобы один чат с десятком ссылок не задерживал остальные.
+# Записи индексируются по job.id: удаление и перестановка помечают старую запись
+# недействительной за O(1), а get пропускает такие записи.
+class FairTaskQueue:
+    def __init__(self):
+        self.entries = {}  # {job.id: [job, enqueued_at, alive]}
+        self.chat_queues = {}  # {normalized_chat_id: deque[entry]}
+        self.chat_sizes = {}  # {normalized_chat_id: число действующих записей}
+        self.ready_chats = collections.deque()  # Порядок обхода чатов с непустыми очередями
+        self.priority = collections.deque()  # Записи, поднятые в начало всей очереди
+        self.size = 0
+        self.not_empty = asyncio.Event()
+        self.dispatched_per_chat = {}  # {normalized_chat_id: сколько задач выдано}
+        self.wait_time_per_chat = {}  # {normalized_chat_id: суммарное ожидание выданных задач, сек}
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def __contains__(self, job):
+        return job.id in self.entries
+
+    def _push(self, job, enqueued_at):
+        chat_key = normalize_chat_id(job.chat_id)
+        entry = [job, enqueued_at, True]
+        self.entries[job.id] = entry
+        chat_queue = self.chat_queues.get(chat_key)
+        if chat_queue is None:
+            chat_queue = self.chat_queues[chat_key] = collections.deque()
+            self.ready_chats.append(chat_key)
+        chat_queue.append(entry)
+        self.chat_sizes[chat_key] = self.chat_sizes.get(chat_key, 0) + 1
+        return entry
+
+    def _discard(self, job):
+        entry = self.entries.pop(job.id, None)
+        if entry is None:
+            return None
+        entry[2] = False
+        chat_key = normalize_chat_id(job.chat_id)
+        self.chat_sizes[chat_key] -= 1
+        if not self.chat_sizes[chat_key]:
+            del self.chat_sizes[chat_key]
+        return entry
+
+    def put_nowait(self, job):
+        self._push(job, time.time())
+        self.size += 1
+        self.not_empty.set()
+
+    async def put(self, job):
+        self.put_nowait(job)
+
+    def _pop_entry(self):
+        while self.priority:
+            entry = self.priority.popleft()
+            if entry[2]:
+                return entry
+        while self.ready_chats:
+            chat_key = self.ready_chats.popleft()
+            chat_queue = self.chat_queues[chat_key]
+            while chat_queue and not chat_queue[0][2]:
+                chat_queue.popleft()  # Удалённые или перемещённые записи
+            entry = chat_queue.popleft() if chat_queue else None
+            if chat_queue:
+                self.ready_chats.append(chat_key)  # Чат уходит в конец очереди обхода
+            else:
+                del self.chat_queues[chat_key]
+            if entry is not None:
+                return entry
+        raise asyncio.QueueEmpty
+
+    def get_nowait(self):
+        if self.size == 0:
+            raise asyncio.QueueEmpty
+        job, enqueued_at, _ = self._pop_entry()
+        self._discard(job)
+        self.size -= 1
+        if self.size == 0:
+            self.not_empty.clear()
+        chat_key = normalize_chat_id(job.chat_id)
+        self.dispatched_per_chat[chat_key] = self.dispatched_per_chat.get(chat_key, 0) + 1
+        self.wait_time_per_chat[chat_key] = self.wait_time_per_chat.get(chat_key, 0) + time.time() - enqueued_at
+        return job
+
+    async def get(self):
+        while self.size == 0:
+            await self.not_empty.wait()
+        return self.get_nowait()
+
+    def remove(self, job):
+        if self._discard(job) is None:
+            return False
+        self.size -= 1
+        if self.size == 0:
+            self.not_empty.clear()
+        return True
+
+    def move_to_front(self, job):
+        # Задача будет выдана следующей, вне очереди чатов
+        entry = self._discard(job)
+        if entry is not None:
+            self.priority.appendleft(self._push(job, entry[1]))
+        return entry is not None
+
+    def clear(self):
+        removed = [entry[0] for entry in self.entries.values()]
+        for entry in self.entries.values():
+            entry[2] = False
+        self.entries.clear()
+        self.chat_queues.clear()
+        self.chat_sizes.clear()
+        self.ready_chats.clear()
+        self.priority.clear()
+        self.size = 0
+        self.not_empty.clear()
+        return removed
+
+    def chat_stats(self):
+        # {normalized_chat_id: (в очереди, выдано, максимальное текущее ожидание, среднее ожидание выданных)}
+        now = time.time()
+        oldest_enqueued = {}
+        for job, enqueued_at, _ in self.entries.values():
+            chat_key = normalize_chat_id(job.chat_id)
+            oldest_enqueued[chat_key] = min(oldest_enqueued.get(chat_key, enqueued_at), enqueued_at)
+        stats = {}
+        for chat_key in set(self.chat_sizes) | set(self.dispatched_per_chat):
+            dispatched = self.dispatched_per_chat.get(chat_key, 0)
+            oldest_wait = now - oldest_enqueued[chat_key] if chat_key in oldest_enqueued else 0
+            average_wait = self.wait_time_per_chat.get(chat_key, 0) / dispatched if dispatched else 0
+            stats[chat_key] = (self.chat_sizes.get(chat_key, 0), dispatched, oldest_wait, average_wait)
+        return stats
+
+# Стадия конвейера обработки видео: не больше limit задач одновременно, остальные ждут в порядке прихода.
+# Лимит можно менять на лету, ожидающие задачи запускаются по мере освобождения мест.
+# Тайм-аут отсчитывается с момента получения места: задача, долго стоявшая в очереди стадии, не прерывается
+# Чат задачи, от имени которой код проходит стадии конвейера. Задаётся в process_video_link
+# и наследуется задачами загрузки, созданными из неё
+current_stage_chat = contextvars.ContextVar('current_stage_chat', default=None)
+
+class PipelineStage:
+    def __init__(self, name, limit, timeout=STAGE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        # Места выдаются по кругу между чатами, как в FairTaskQueue: пачка ссылок из одного чата
+        # не занимает стадию раньше задач других чатов
+        self.waiters = {}  # {normalized_chat_id: deque[Future]}
+        self.ready_chats = collections.deque()  # Порядок обхода чатов с ожидающими задачами
+        self.deadlines = {}  # {задача: [таймер отмены, истёк ли тайм-аут]}
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def waiting(self):
+        return sum(1 for chat_waiters in self.waiters.values() for waiter in chat_waiters if not waiter.done())
+
+    def _next_waiter(self):
+        while self.ready_chats:
+            chat_key = self.ready_chats.popleft()
+            chat_waiters = self.waiters[chat_key]
+            while chat_waiters and chat_waiters[0].done():
+                chat_waiters.popleft()
+            waiter = chat_waiters.popleft() if chat_waiters else None
+            if chat_waiters:
+                self.ready_chats.append(chat_key)
+            else:
+                del self.waiters[chat_key]
+            if waiter is not None:
+                return waiter
+        return None
+
+    def _wake(self):
+        while self.active < self.limit:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self.active += 1
+            waiter.set_result(None)
+
+    def _start_deadline(self):
+        task = asyncio.current_task()
+        deadline = [None, False]
+
+        def expire():
+            deadline[1] = True
+            task.cancel()
+        deadline[0] = asyncio.get_running_loop().call_later(self.timeout, expire)
+        self.deadlines[task] = deadline
+
+    async def __aenter__(self):
+        if self.active < self.limit and not self.waiting():
+            self.active += 1
+            self._start_deadline()
+            return self
+        waiter = asyncio.get_running_loop().create_future()
+        chat_key = current_stage_chat.get()
+        chat_waiters = self.waiters.get(chat_key)
+        if chat_waiters is None:
+            chat_waiters = self.waiters[chat_key] = collections.deque()
+            self.ready_chats.append(chat_key)
+        chat_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Место уже выдано, но задачу отменили до старта — возвращаем его
+            if waiter.done() and not waiter.cancelled():
+                self.active -= 1
+                self._wake()
+            raise
+        self._start_deadline()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self._wake()
+        task = asyncio.current_task()
+        timer, expired = self.deadlines.pop(task, (None, False))
+        if timer is not None:
+            timer.cancel()
+        if expired and exc_type is asyncio.CancelledError:
+            # Отмену вызвал наш таймер, а не остановка задачи — превращаем её в обычную ошибку стадии
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            raise asyncio.TimeoutError(f"стадия {self.name} превысила тайм-аут {self.timeout} секунд")
+        return False
+
+def get_transcode_concurrency():
+    cores = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    return max(1, cores // FFMPEG_THREADS_PER_ENCODE)
+
 # Класс состояния программы
 class AppState:
     def __init__(self):
@@ -449,13 +1289,24 @@ class AppState:
         self.auth_data = None
         self.session_exists = os.path.exists('bot.session')
         self.chat_cache = {}
+        self.entities = EntityCache(ENTITY_CACHE_TTL)  # Кэш чатов и отправителей для обработки ссылок
         self.participants_cache = {}
         self.user_cache = {}
         self.participant_to_chats = {}
         self.switch_is_on = False
         self.should_be_active = True
         self.active_tasks = []
-        self.task_queue = asyncio.Queue()
+        self.task_queues = {lane: FairTaskQueue() for lane in TASK_LANES}
+        self.worker_count = DEFAULT_WORKER_COUNT  # Параллельных загрузок YouTube (стадия download)
+        self.pipeline_stages = {
+            'metadata': PipelineStage('metadata', METADATA_CONCURRENCY),
+            'download': PipelineStage('download', DEFAULT_WORKER_COUNT),
+            'transcode': PipelineStage('transcode', get_transcode_concurrency()),
+            'upload': PipelineStage('upload', UPLOAD_CONCURRENCY),
+        }
+        self.ytdlp_use_processes = False  # yt-dlp в пуле процессов вместо пула потоков
+        self.ytdlp_executor = None
+        self.ytdlp_manager = None  # multiprocessing.Manager для очередей прогресса в режиме процессов
         self.flood_wait_until = 0
         self.flood_wait_lock = asyncio.Lock()
         self.links_processed_per_chat = {}
@@ -464,6 +1315,9 @@ class AppState:
         self.current_user_id = None
         self.bot_signature_id = None
         self.processing_links = set()
+        self.media_flights = {}  # {url видео YouTube: MediaFlight} — общие загрузки для одинаковых ссылок
+        self.video_cache_mb = DEFAULT_VIDEO_CACHE_MB  # 0 — кэш видео отключён
+        self.video_cache_pins = set()  # Файлы кэша, которые сейчас выгружаются: не вытесняются
         self.gpu_enabled = False
         self.only_me_mode = False
         self.remember_me = False
@@ -472,7 +1326,15 @@ class AppState:
         self.youtube_unlimited_mode = False
         self.responses_enabled_before_unlimited = True
         # Новые поля
-        self.task_queue_items = {}  # Словарь {task_id: (chat_id, message_id, text, message, timestamp)}
+        self.jobs = JobRegistry()  # Задачи в проверке, очереди и обработке
+        self.signatures = SignatureIndex(SIGNATURE_INDEX_SIZE)  # Чужие ответы на ссылки из потока обновлений
+        self.recent_messages = RecentMessages(RECENT_MESSAGES_PER_CHAT)
+        self.competitor_window_days = DEFAULT_COMPETITOR_WINDOW_DAYS
+        self.competitor_last_seen = {}  # {normalized_chat_id: когда последний раз отвечал другой бот}
+        self.competitor_journal = {}  # {normalized_chat_id: (новых появлений, last_seen)}, ждут записи в SQLite
+        # Изменения таблицы jobs, ожидающие групповой записи: {(chat_id, message_id): строка или None для удаления}
+        self.job_journal = {}
+        self.prefilter_drops = collections.Counter()  # {шаг предфильтра: отсеяно сообщений}, 'passed' — прошли дальше
         self.chat_logs = {}  # Словарь {chat_title: [(timestamp, level, msg, sender_info), ...]}
 
     async def ensure_client_disconnected(self):
@@ -501,128 +1363,583 @@ class AppState:
 
 state = AppState()
 
-# Функции обработки видео (адаптированные под Telethon)
-async def update_progress_bar_video(chat_id, message_id, url, platform, downloaded, total, last_percentage, last_update_time, last_message_text=None):
-    if last_message_text is None:
-        last_message_text = [f"Обрабатываю ссылку {url}\n{platform}\n[{' ' * 10}] 0%"]
+PREFILTER_STEP_LABELS = {
+    'switch_off': 'бот выключен',
+    'not_own': 'не мои',
+    'not_selected_chat': 'не из выбранных чатов',
+    'no_text': 'без текста',
+    'own_error': 'свои ошибки',
+    'rewritten': 'уже обработанные ссылки',
+    'no_link': 'без ссылки',
+}
+REWRITTEN_LINK_MARKERS = (("vxtiktok.com", "TikTok"), ("fxtwitter.com", "Twitter"), ("ddinstagram.com", "Instagram"))
+
+# Дешёвые проверки входящего сообщения без запросов к Telegram, от самой частой причины отказа к редкой.
+# Возвращает (причина отказа или None, найденные ссылки из scan_video_links)
+def prefilter_message(chat_id, message, text):
+    if state.only_me_mode:
+        if message.sender_id != state.current_user_id:
+            return 'not_own', None
+    else:
+        if not state.switch_is_on:
+            return 'switch_off', None
+        if normalize_chat_id(chat_id) not in get_selected_chat_ids():
+            return 'not_selected_chat', None
+    if not text:
+        return 'no_text', None
+    if text.startswith("Ошибка обработки") and message.sender_id == state.current_user_id:
+        return 'own_error', None
+    for marker, _ in REWRITTEN_LINK_MARKERS:
+        if marker in text:
+            return 'rewritten', None
+    links = scan_video_links(text)
+    if not links:
+        return 'no_link', None
+    return None, links
+
+def get_lane_worker_count(lane):
+    if lane == 'rewrite':
+        return REWRITE_WORKER_COUNT
+    # В конвейере одновременно находятся задачи всех стадий плюс ограниченный буфер ожидающих между ними.
+    # Места в стадиях выдаются по кругу между чатами, поэтому взятые из очереди задачи не обгоняют другие чаты
+    return sum(stage.limit for stage in state.pipeline_stages.values()) + PIPELINE_QUEUE_SIZE
+
+def clear_task_queues():
+    # Очищается только память: задачи остаются в таблице jobs и восстанавливаются при следующем запуске
+    for queue in state.task_queues.values():
+        for job in queue.clear():
+            state.jobs.remove(job)
+            cancel_prefetch(job)
+    flush_job_journal()
+
+# Сохранение очереди в SQLite: изменения копятся в памяти и пишутся пачкой раз в тик task_manager
+def journal_job(job):
+    # Сохраняется первая ссылка сообщения; при восстановлении текст берётся из самого сообщения
+    link_start, link_end = job.links[0][2]
+    state.job_journal[(job.chat_id, job.message_id)] = (job.chat_id, job.message_id, job.text[link_start:link_end], job.created_at)
+
+def unjournal_job(chat_id, message_id):
+    state.job_journal[(chat_id, message_id)] = None
+
+def flush_job_journal():
+    flush_competitor_journal()
+    if not state.job_journal:
+        return
+    journal, state.job_journal = state.job_journal, {}
+    saved_jobs = [row for row in journal.values() if row is not None]
+    deleted_jobs = [key for key, row in journal.items() if row is None]
+    try:
+        write_jobs(saved_jobs, deleted_jobs)
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить очередь задач: {str(e)}")
+        # Более новые изменения, сделанные во время записи, имеют приоритет
+        journal.update(state.job_journal)
+        state.job_journal = journal
+
+# Управление задачами из окна задач: все операции синхронные и не ждут завершения задачи
+def cancel_job(job_id):
+    job = state.jobs.get(job_id)
+    if job is None:
+        return None
+    if job.stage == 'running':
+        # Воркер получит CancelledError и сам уберёт задачу из таблицы
+        job.task.cancel()
+    else:
+        if job.stage == 'queued':
+            state.task_queues[job.lane].remove(job)
+        state.jobs.remove(job)
+        cancel_prefetch(job)
+    unjournal_job(job.chat_id, job.message_id)
+    return job
+
+def cancel_queued_jobs():
+    removed = 0
+    for job in state.jobs:
+        if job.stage in ('pending', 'queued'):
+            cancel_job(job.id)
+            removed += 1
+    return removed
+
+def move_job_to_front(job_id):
+    job = state.jobs.get(job_id)
+    return job is not None and job.stage == 'queued' and state.task_queues[job.lane].move_to_front(job)
+
+def cancel_prefetch(job):
+    if job.prefetch is None:
+        return
+    if not job.prefetch.done():
+        job.prefetch.cancel()
+    elif not job.prefetch.cancelled():
+        job.prefetch.exception()  # Ошибка пробного запроса больше никому не нужна
+    job.prefetch = None
+
+# Запуск yt-dlp вне цикла событий Qt/asyncio
+def get_ytdlp_executor():
+    executor_class = ProcessPoolExecutor if state.ytdlp_use_processes else ThreadPoolExecutor
+    if not isinstance(state.ytdlp_executor, executor_class):
+        if state.ytdlp_executor is not None:
+            state.ytdlp_executor.shutdown(wait=False)
+        if state.ytdlp_use_processes:
+            state.ytdlp_executor = ProcessPoolExecutor(max_workers=YTDLP_EXECUTOR_WORKERS)
+        else:
+            state.ytdlp_executor = ThreadPoolExecutor(max_workers=YTDLP_EXECUTOR_WORKERS, thread_name_prefix="yt-dlp")
+        logging.info(f"yt-dlp выполняется в пуле {'процессов' if state.ytdlp_use_processes else 'потоков'}")
+    return state.ytdlp_executor
+
+class LoopProgressSink:
+    # Передаёт события прогресса из потока yt-dlp в цикл событий
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.cancelled = False
+
+    def put(self, event):
+        if self.cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Загрузка отменена")
+        self.loop.call_soon_threadsafe(self.callback, event)
+
+async def read_progress_queue(progress_queue, callback):
+    loop = asyncio.get_running_loop()
+    while True:
+        event = await loop.run_in_executor(None, progress_queue.get)
+        if event is None:
+            break
+        callback(event)
+
+async def run_ytdlp_in_executor(url, ydl_opts, download, on_progress=None, info=None):
+    loop = asyncio.get_running_loop()
+    executor = get_ytdlp_executor()
+    if isinstance(executor, ProcessPoolExecutor):
+        progress_queue = None
+        reader = None
+        if on_progress is not None:
+            if state.ytdlp_manager is None:
+                state.ytdlp_manager = multiprocessing.Manager()
+            progress_queue = state.ytdlp_manager.Queue()
+            reader = asyncio.create_task(read_progress_queue(progress_queue, on_progress))
+        try:
+            return await loop.run_in_executor(executor, run_ytdlp, url, ydl_opts, download, progress_queue, info)
+        finally:
+            if reader is not None:
+                progress_queue.put(None)
+                await reader
 
-    current_time = time.time()
+    progress_sink = LoopProgressSink(loop, on_progress) if on_progress is not None else None
+    try:
+        return await loop.run_in_executor(executor, run_ytdlp, url, ydl_opts, download, progress_sink, info)
+    except asyncio.CancelledError:
+        # Поток нельзя прервать извне: останавливаем загрузку на следующем событии прогресса
+        if progress_sink is not None:
+            progress_sink.cancelled = True
+        raise
 
-    async with state.flood_wait_lock:
-        if current_time < state.flood_wait_until:
-            logging.info(f"Пропускаем обновление прогресс-бара: FLOOD_WAIT до {state.flood_wait_until}")
-            return False
+def get_youtube_url(video_id):
+    return f"https://youtube.com/watch?v={video_id}"
 
-    if total <= 0:
-        return True
+def build_youtube_ydl_opts(outtmpl=None):
+    ydl_opts = {
+        'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
+        'merge_output_format': 'mp4',
+        'quiet': True,
+        'no_warnings': True,
+        'extractor_list': ['youtube'],
+    }
+    if outtmpl:
+        ydl_opts['outtmpl'] = outtmpl
+
+    # Добавляем прокси для ByeDPI, если он включён
+    if get_byedpi_enabled():
+        presets = get_byedpi_presets()
+        active_preset = next((preset for preset in presets if preset['name'] == 'Default'), None)
+        if active_preset:
+            ydl_opts['proxy'] = f"socks5://127.0.0.1:{active_preset['port']}"
+            ydl_opts['force_ipv4'] = True
+            ydl_opts['geo_bypass'] = True
+    return ydl_opts
+
+async def prefetch_youtube_info(url):
+    # Запускается сразу при обнаружении ссылки: к концу задержки против коллизий длительность уже известна
+    async with state.pipeline_stages['metadata']:
+        return await run_ytdlp_in_executor(url, build_youtube_ydl_opts(), False)
 
-    percentage = min(int((downloaded / total) * 100), 100)
-    if (percentage >= last_percentage[0] + 5 or percentage == 100) and (current_time - last_update_time[0] >= 5):
+async def remove_temp_files(paths, chat_title, sender_info):
+    for f in paths:
+        if f and os.path.exists(f):
+            for attempt in range(3):
+                try:
+                    os.remove(f)
+                    break
+                except PermissionError as e:
+                    if "[WinError 32]" in str(e):
+                        await asyncio.sleep(1)
+                    else:
+                        logging.error(f"Не удалось удалить временный файл: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                        break
+                except Exception as e:
+                    logging.error(f"Не удалось удалить временный файл: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                    break
+            else:
+                logging.error(f"Не удалось удалить временный файл после 3 попыток: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+
+# Кэш видео на диске. Ключ — (платформа, id видео, профиль кодирования), порядок LRU — по mtime файла,
+# поэтому кэш можно разделять между несколькими копиями программы: файлы появляются через атомарный os.replace,
+# а занятые другим процессом файлы просто не удаляются
+def get_video_cache_path(link_key, profile=VIDEO_ENCODE_PROFILE):
+    digest = hashlib.sha1(f"{link_key[0]}:{link_key[1]}:{profile}".encode('utf-8')).hexdigest()
+    return os.path.join(VIDEO_CACHE_DIR, f"{digest}.mp4")
+
+def load_cached_video(cache_path):
+    # Возвращает сохранённые метаданные видео или None, если в кэше его нет
+    if not state.video_cache_mb:
+        return None
+    try:
+        with open(f"{cache_path}.json", encoding='utf-8') as f:
+            info = json.load(f)
+        os.utime(cache_path)  # Отмечаем использование для LRU
+    except (OSError, ValueError):
+        return None
+    return info
+
+def is_video_cached(cache_path):
+    # Только проверка наличия: время использования для LRU обновляет load_cached_video, когда файл действительно нужен
+    return bool(state.video_cache_mb) and os.path.exists(cache_path) and os.path.exists(f"{cache_path}.json")
+
+def store_cached_video(cache_path, final_file, info):
+    # Переносит готовый файл в кэш и возвращает путь, по которому его теперь читать
+    if not state.video_cache_mb:
+        return final_file
+    temp_meta = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_meta, 'w', encoding='utf-8') as f:
+            json.dump({key: info.get(key) for key in ('id', 'title', 'duration', 'width', 'height')}, f)
+        os.replace(temp_meta, f"{cache_path}.json")
+        os.replace(final_file, cache_path)
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить видео в кэш: {str(e)}")
+        with contextlib.suppress(OSError):
+            os.remove(temp_meta)
+        return final_file
+    trim_video_cache()
+    return cache_path
+
+def trim_video_cache():
+    budget = state.video_cache_mb * 1024 * 1024
+    entries = []
+    for filename in os.listdir(VIDEO_CACHE_DIR):
+        if not filename.endswith('.mp4'):
+            continue
+        path = os.path.join(VIDEO_CACHE_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path in state.video_cache_pins:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue  # Файл открыт другим процессом, удалим в следующий раз
+        with contextlib.suppress(OSError):
+            os.remove(f"{path}.json")
+        total -= size
+        removed += 1
+    if removed:
+        logging.info(f"🗑 Кэш видео: удалено файлов {removed}, занято {total // (1024 * 1024)} МБ")
+
+def needs_youtube_probe(link_key):
+    # Опережающий запрос метаданных не нужен, если видео уже есть в кэше или заведомо будет отклонено
+    if get_cached_media(link_key, VIDEO_ENCODE_PROFILE) is not None or is_video_cached(get_video_cache_path(link_key)):
+        return False
+    metadata = get_video_metadata(link_key)
+    return metadata is None or (metadata['available'] and metadata['duration'] <= YOUTUBE_MAX_DURATION)
+
+# Общая загрузка и конвертация одного видео для всех задач с этим url (одно видео, разосланное по нескольким чатам)
+class MediaFlight:
+    __slots__ = ('url', 'cache_path', 'task', 'listeners', 'users')
+
+    def __init__(self, url):
+        self.url = url
+        self.cache_path = get_video_cache_path(get_link_key(url))
+        self.task = None
+        self.listeners = set()  # schedule_progress_update каждой ожидающей задачи
+        self.users = 0
+
+    def notify(self, done, total, stage_label):
+        for listener in list(self.listeners):
+            listener(done, total, stage_label)
+
+async def fetch_youtube_video(flight, max_duration, prefetch, chat_title, sender_info):
+    # Метаданные → загрузка → конвертация. Возвращает (info, final_file); final_file = None, если видео отклонено по длительности
+    url = flight.url
+    cached_info = load_cached_video(flight.cache_path)
+    if cached_info is not None and not (max_duration and cached_info.get('duration', 0) > max_duration):
+        logging.info(f"📦 Видео взято из кэша: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return cached_info, flight.cache_path
+
+    unique_suffix = f"{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+    temp_file_base = f"temp-files/temp_{unique_suffix}"
+    temp_file = f"{temp_file_base}.%(ext)s"
+    final_file = None
+
+    def progress_hook(d):
+        # Вызывается в цикле событий: события из потока/процесса yt-dlp передаются через run_ytdlp_in_executor
+        if d['status'] == 'downloading':
+            flight.notify(d.get('downloaded_bytes', 0), d.get('total_bytes', 0), "Загрузка")
+        elif d['status'] == 'finished':
+            flight.notify(100, 100, "Загрузка")
+
+    ydl_opts = build_youtube_ydl_opts(temp_file)
+    if 'proxy' in ydl_opts:
+        logging.info(f"🟢 [ByeDPI] Используется прокси {ydl_opts['proxy']} для загрузки видео", extra={'chat_title': chat_title, 'sender_info': sender_info})
+
+    try:
+        # Недавно проверенное видео, которое всё равно будет отклонено, не запрашиваем у YouTube повторно
+        link_key = get_link_key(url)
+        metadata = get_video_metadata(link_key)
+        if metadata is not None and not metadata['available']:
+            logging.info(f"Видео недоступно по данным кэша: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            return None, None
+        if metadata is not None and max_duration and metadata['duration'] > max_duration:
+            logging.info(f"Длительность видео взята из кэша: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            return metadata, None
+
+        # Единственное обращение к YouTube: метаданные и выбранные форматы, скачивание использует этот же info.
+        # Обычно они уже получены опережающим запросом, запущенным при обнаружении ссылки
+        info = None
+        prefetched = False
+        try:
+            if prefetch is not None and not prefetch.cancelled():
+                try:
+                    info, _ = await asyncio.shield(prefetch)
+                    prefetched = True
+                except asyncio.CancelledError:
+                    # Пробный запрос отменила задача, которая его начала, а видео всё ещё ждут другие чаты
+                    if not prefetch.cancelled():
+                        raise
+            if not prefetched:
+                async with state.pipeline_stages['metadata']:
+                    info, _ = await run_ytdlp_in_executor(url, ydl_opts, False)
+        except YtdlpDownloadError as e:
+            # Ожидаемые ошибки (видео удалено, приватное, заблокировано) запоминаем, сетевые сбои — нет
+            if not e.expected:
+                raise
+            logging.warning(f"⚠️ YouTube: {str(e)} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            info = None
+        if not info or 'duration' not in info:
+            save_video_metadata(link_key, None)
+            return None, None
+        save_video_metadata(link_key, info)
+        if max_duration and info.get('duration', 0) > max_duration:
+            return info, None
+
+        try:
+            async with state.pipeline_stages['download']:
+                info, temp_file = await run_ytdlp_in_executor(url, ydl_opts, True, progress_hook, info=info)
+        except Exception as e:
+            logging.error(f"🔴 Ошибка: Не удалось загрузить видео {url} с помощью yt_dlp ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            raise
+        final_file = temp_file.rsplit('.', 1)[0] + '_telegram.mp4'
+
+        ffmpeg_cmd = [
+            'ffmpeg', '-i', temp_file,
+            '-c:v', 'h264_nvenc' if state.gpu_enabled else 'libx264',
+            '-profile:v', 'baseline',
+            '-b:v', '1000k', '-maxrate', '1200k', '-bufsize', '2000k',
+            '-c:a', 'aac', '-b:a', '96k', '-ar', '44100',
+            '-vf', 'scale=720:-2,format=yuv420p',
+            '-preset', 'p4' if state.gpu_enabled else 'veryfast',
+            '-threads', str(FFMPEG_THREADS_PER_ENCODE),
+            '-movflags', '+faststart',
+            '-y', final_file
+        ]
+        async with state.pipeline_stages['transcode']:
+            try:
+                await run_ffmpeg(ffmpeg_cmd, info.get('duration', 0), lambda done, total: flight.notify(done, total, "Конвертация"))
+            except subprocess.CalledProcessError as e:
+                logging.error(f"🔴 Ошибка: Не удалось обработать видео {url} с помощью ffmpeg ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                if state.gpu_enabled:
+                    logging.warning(f"⚠️ GPU-режим не сработал, используется CPU ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                    ffmpeg_cmd[ffmpeg_cmd.index('-c:v') + 1] = 'libx264'
+                    ffmpeg_cmd[ffmpeg_cmd.index('-preset') + 1] = 'veryfast'
+                    await run_ffmpeg(ffmpeg_cmd, info.get('duration', 0), lambda done, total: flight.notify(done, total, "Конвертация (CPU)"))
+                else:
+                    raise
+        final_file = store_cached_video(flight.cache_path, final_file, info)
+        return info, final_file
+    except BaseException:
+        await remove_temp_files([final_file], chat_title, sender_info)
+        raise
+    finally:
+        await remove_temp_files([temp_file], chat_title, sender_info)
+
+def join_media_flight(url, max_duration, prefetch, chat_title, sender_info):
+    # Возвращает (flight, joined): joined = True, если видео уже скачивается или готово для другой задачи
+    flight = state.media_flights.get(url)
+    joined = flight is not None and not (flight.task.done() and (flight.task.cancelled() or flight.task.exception() is not None))
+    if not joined:
+        flight = MediaFlight(url)
+        flight.task = asyncio.create_task(fetch_youtube_video(flight, max_duration, prefetch, chat_title, sender_info))
+        state.media_flights[url] = flight
+        state.video_cache_pins.add(flight.cache_path)
+    flight.users += 1
+    return flight, joined
+
+async def release_media_flight(flight, chat_title, sender_info):
+    flight.users -= 1
+    if flight.users > 0:
+        return
+    if state.media_flights.get(flight.url) is flight:
+        del state.media_flights[flight.url]
+        state.video_cache_pins.discard(flight.cache_path)
+    if not flight.task.done():
+        # Видео больше никто не ждёт: загрузка останавливается, временные файлы удаляет сама задача
+        flight.task.cancel()
+    elif not flight.task.cancelled() and flight.task.exception() is None:
+        _, final_file = flight.task.result()
+        if final_file != flight.cache_path:
+            await remove_temp_files([final_file], chat_title, sender_info)
+
+# Асинхронный запуск ffmpeg с разбором прогресса из -progress pipe:1
+async def run_ffmpeg(ffmpeg_cmd, duration, on_progress=None):
+    cmd = [ffmpeg_cmd[0], '-progress', 'pipe:1', '-nostats', *ffmpeg_cmd[1:]]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        creationflags=subprocess.CREATE_NO_WINDOW
+    )
+    stderr_tail = collections.deque(maxlen=20)  # Последние строки stderr для текста ошибки
+
+    async def read_stderr():
+        async for line in process.stderr:
+            stderr_tail.append(line.decode('utf-8', errors='replace').rstrip())
+
+    stderr_task = asyncio.create_task(read_stderr())
+    try:
+        async for line in process.stdout:
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            # out_time_ms в ffmpeg исторически тоже в микросекундах
+            if key in ('out_time_us', 'out_time_ms') and value.isdigit() and duration and on_progress is not None:
+                on_progress(min(int(value) / 1_000_000, duration), duration)
+        await stderr_task
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        raise
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr="\n".join(stderr_tail))
+
+# Функции обработки видео (адаптированные под Telethon)
+def format_video_progress(platform, progress_state):
+    # progress_state: {url: [метка стадии, процент]} — по строке прогресса на каждое видео сообщения
+    lines = []
+    for url, (stage_label, percentage) in progress_state.items():
         bar_length = 10
         progress = bar_length * percentage / 100
         filled = int(progress)
         half = '▌' if progress - filled >= 0.5 else ''
         bar = '█' * filled + half + ' ' * (bar_length - filled - (1 if half else 0))
-        progress_text = f"Обрабатываю ссылку {url}\n{platform}\n[{bar}] {percentage}%"
+        stage_prefix = f"{stage_label}: " if stage_label else ""
+        lines.append((url, f"{stage_prefix}[{bar}] {percentage}%"))
+    if len(lines) == 1:
+        url, bar_line = lines[0]
+        return f"Обрабатываю ссылку {url}\n{platform}\n{bar_line}"
+    return f"Обрабатываю ссылки\n{platform}\n" + "\n".join(f"{url}\n{bar_line}" for url, bar_line in lines)
+
+async def update_progress_bar_video(chat_id, message_id, platform, progress_state, last_message_text):
+    current_time = time.time()
 
-        try:
-            current_message = await state.client.get_messages(chat_id, ids=message_id)
-            if not current_message:
-                logging.warning(f"Сообщение с ID {message_id} недоступно")
-                return False
-            current_text = current_message.text or ""
-        except Exception as e:
-            logging.warning(f"Не удалось получить текущее сообщение с ID {message_id}: {e}")
+    async with state.flood_wait_lock:
+        if current_time < state.flood_wait_until:
+            logging.info(f"Пропускаем обновление прогресс-бара: FLOOD_WAIT до {state.flood_wait_until}")
             return False
 
-        parts = current_text.split("➖➖➖", 1)
-        if len(parts) == 2:
-            original_text = parts[0].strip()
-        else:
-            try:
-                original_message = await state.client.get_messages(chat_id, ids=current_message.reply_to_msg_id) if current_message.reply_to_msg_id else None
-                original_text = original_message.text if original_message else url
-                logging.debug(f"Разделитель отсутствует, взят исходный текст: {original_text}")
-            except Exception as e:
-                original_text = url
-                logging.warning(f"Не удалось получить исходное сообщение: {e}")
-
-        new_text = f"{original_text}\n➖➖➖\n{progress_text}\n[BotSignature:{state.bot_signature_id}]"
+    progress_text = format_video_progress(platform, progress_state)
+    fallback_text = "\n".join(progress_state)
 
-        if new_text == last_message_text[0]:
-            logging.debug(f"Текст прогресс-бара не изменился, пропускаем обновление: {new_text}")
-            return True
+    try:
+        current_message = await state.client.get_messages(chat_id, ids=message_id)
+        if not current_message:
+            logging.warning(f"Сообщение с ID {message_id} недоступно")
+            return False
+        current_text = current_message.text or ""
+    except Exception as e:
+        logging.warning(f"Не удалось получить текущее сообщение с ID {message_id}: {e}")
+        return False
 
+    parts = current_text.split("➖➖➖", 1)
+    if len(parts) == 2:
+        original_text = parts[0].strip()
+    else:
         try:
-            await state.client.edit_message(chat_id, message_id, new_text)
-            last_percentage[0] = percentage
-            last_update_time[0] = current_time
-            last_message_text[0] = new_text
+            original_message = await state.client.get_messages(chat_id, ids=current_message.reply_to_msg_id) if current_message.reply_to_msg_id else None
+            original_text = original_message.text if original_message else fallback_text
+            logging.debug(f"Разделитель отсутствует, взят исходный текст: {original_text}")
         except Exception as e:
-            if "message is not modified" in str(e):
-                return True
-            elif "FLOOD_WAIT" in str(e):
-                wait_time = int(re.search(r"FLOOD_WAIT_(\d+)", str(e)).group(1)) if re.search(r"FLOOD_WAIT_(\d+)", str(e)) else 10
-                async with state.flood_wait_lock:
-                    state.flood_wait_until = current_time + wait_time
-                logging.warning(f"FLOOD_WAIT на {wait_time} секунд, ждём до {state.flood_wait_until}")
-                await asyncio.sleep(wait_time)
-                return False
-            elif "message ID is invalid" in str(e):
-                logging.warning(f"Сообщение с ID {message_id} недействительно: {e}")
-                return False
-            else:
-                logging.warning(f"Ошибка обновления прогресс-бара: {e}")
-                return False
-    return True
+            original_text = fallback_text
+            logging.warning(f"Не удалось получить исходное сообщение: {e}")
 
-async def process_video(chat_id, message_id, url, platform, max_duration, message, sender_info, original_url=None):
-    is_forwarded = message.fwd_from is not None
+    new_text = f"{original_text}\n➖➖➖\n{progress_text}\n[BotSignature:{state.bot_signature_id}]"
+
+    if new_text == last_message_text[0]:
+        logging.debug(f"Текст прогресс-бара не изменился, пропускаем обновление: {new_text}")
+        return True
 
-    # Проверяем тип чата и права на редактирование
     try:
-        chat_entity = await state.client.get_entity(chat_id)
-        chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
-        
-        # Определяем, можно ли редактировать сообщение
-        if isinstance(chat_entity, Channel):
-            # Для каналов и супергрупп
-            if chat_entity.megagroup:
-                # Для супергрупп используем старую логику, если нет прав на редактирование
-                is_own_message = message.sender_id == state.current_user_id
-                can_edit = is_own_message and not is_forwarded
-                if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
-                    if chat_entity.admin_rights.edit_messages:
-                        can_edit = not is_forwarded  # Если есть права, игнорируем is_own_message
-            else:
-                # Для обычных каналов проверяем права
-                can_edit = not is_forwarded
-                if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
-                    can_edit = chat_entity.admin_rights.edit_messages and not is_forwarded
-                else:
-                    can_edit = False  # Если нет прав админа, редактировать нельзя
-        else:
-            # Для личных переписок и групп используем старую логику
-            is_own_message = message.sender_id == state.current_user_id
-            can_edit = is_own_message and not is_forwarded
+        await state.client.edit_message(chat_id, message_id, new_text)
+        last_message_text[0] = new_text
     except Exception as e:
-        logging.error(f"Не удалось проверить права на редактирование для чата {chat_id}: {str(e)}", extra={'chat_title': 'Неизвестный чат', 'sender_info': sender_info})
-        chat_title = "Неизвестный чат"
-        # Если не удалось проверить права, считаем, что редактировать нельзя
-        is_own_message = message.sender_id == state.current_user_id
-        can_edit = is_own_message and not is_forwarded
+        if "message is not modified" in str(e):
+            return True
+        elif "FLOOD_WAIT" in str(e):
+            wait_time = int(re.search(r"FLOOD_WAIT_(\d+)", str(e)).group(1)) if re.search(r"FLOOD_WAIT_(\d+)", str(e)) else 10
+            async with state.flood_wait_lock:
+                state.flood_wait_until = current_time + wait_time
+            logging.warning(f"FLOOD_WAIT на {wait_time} секунд, ждём до {state.flood_wait_until}")
+            await asyncio.sleep(wait_time)
+            return False
+        elif "message ID is invalid" in str(e):
+            logging.warning(f"Сообщение с ID {message_id} недействительно: {e}")
+            return False
+        else:
+            logging.warning(f"Ошибка обновления прогресс-бара: {e}")
+            return False
+    return True
 
-    # Проверяем сигнатуру в текущем сообщении
-    current_message = await state.client.get_messages(chat_id, ids=message_id)
-    if current_message and re.search(r'\[BotSignature:[0-9a-f-]+\]', current_message.text or ""):
-        logging.warning(f"⚠️ Ссылка уже обработана: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-        return False
+def get_video_attributes(info):
+    return [
+        DocumentAttributeVideo(
+            duration=int(info.get('duration') or 0),
+            w=min(info.get('width') or 720, 720),
+            h=min(info.get('height') or 1280, 1280),
+            supports_streaming=True
+        )
+    ]
+
+async def process_video(job, urls, platform, max_duration, rewritten_text=""):
+    # Все видео YouTube из одного сообщения: загружаются параллельно, одно отправляется правкой сообщения,
+    # несколько — одним альбомом. rewritten_text — уже переписанные ссылки других платформ из того же сообщения
+    chat_id, message_id, message = job.chat_id, job.message_id, job.message
+    chat_title, sender_info, can_edit = job.chat_title, job.sender_info, job.can_edit
+    urls_text = "\n".join(urls)
 
     # Сохраняем исходный текст сообщения
-    original_text = message.text or url  # Всегда сохраняем текст или URL
+    original_text = message.text or urls_text  # Всегда сохраняем текст или URL
+
+    # Прогресс всех видео пишется в одно сообщение, по строке на каждое видео
+    progress_state = {url: [None, 0] for url in urls}
 
     # Формируем текст для начала обработки
-    progress_text = f"Обрабатываю ссылку {url}\n{platform}\n[{' ' * 10}] 0%\n[BotSignature:{state.bot_signature_id}]"
+    progress_text = f"{format_video_progress(platform, progress_state)}\n[BotSignature:{state.bot_signature_id}]"
     try:
         initial_text = f"{original_text}\n➖➖➖\n{progress_text}"
         if can_edit:
@@ -634,428 +1951,311 @@ async def process_video(chat_id, message_id, url, platform, max_duration, messag
                 logging.error(f"🔴 Ошибка: Не удалось отправить сообщение ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
                 return False
     except Exception as e:
-        logging.error(f"🔴 Ошибка: Не удалось отправить/отредактировать сообщение для {url} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        state.entities.invalidate_chat(chat_id)  # Права на редактирование могли измениться
+        logging.error(f"🔴 Ошибка: Не удалось отправить/отредактировать сообщение для {urls_text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
         return False
 
-    last_percentage = [0]
-    last_update_time = [time.time()]
+    # Частота правок общая для всех видео сообщения, проценты — свои у каждого
     last_message_text = [initial_text]
-    temp_file = None
-    final_file = None
     can_update_progress = [True]
-    last_hook_call = [0]
+    last_hook_call = [time.time()]
 
-    unique_suffix = f"{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
-    temp_file_base = f"temp-files/temp_{unique_suffix}"
-    temp_file = f"{temp_file_base}.%(ext)s"
-    final_file = f"{temp_file_base}_telegram.mp4"
-
-    def progress_hook(d):
-        nonlocal can_update_progress, last_hook_call
-        current_time = time.time()
-        if current_time < state.flood_wait_until:
-            return
-        if current_time - last_hook_call[0] < 5:
-            return
-        if d['status'] == 'downloading' and can_update_progress[0]:
-            total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0)
-            downloaded = d.get('downloaded_bytes', 0)
-            loop = asyncio.get_event_loop()
-            task = loop.create_task(update_progress_bar_video(
-                chat_id, progress_msg.id, url, platform, downloaded, total, last_percentage, last_update_time, last_message_text
-            ))
-            task.add_done_callback(
-                lambda t: can_update_progress.__setitem__(0, False) if not t.result() else None
-            )
-            last_hook_call[0] = current_time
-        elif d['status'] == 'finished' and can_update_progress[0]:
-            loop = asyncio.get_event_loop()
-            task = loop.create_task(update_progress_bar_video(
-                chat_id, progress_msg.id, url, platform, 100, 100, last_percentage, last_update_time, last_message_text
+    def make_progress_listener(url):
+        def schedule_progress_update(done, total, stage_label):
+            if total <= 0:
+                return
+            # Каждая стадия показывается в строке своего видео, прогресс начинается с нуля
+            progress_state[url] = [stage_label, min(int(done / total * 100), 100)]
+            current_time = time.time()
+            if not can_update_progress[0] or current_time < state.flood_wait_until:
+                return
+            # Финальные 100% не пропускаем, промежуточные обновления не чаще раза в 5 секунд
+            if current_time - last_hook_call[0] < 5 and done < total:
+                return
+            task = asyncio.get_running_loop().create_task(update_progress_bar_video(
+                chat_id, progress_msg.id, platform, progress_state, last_message_text
             ))
             task.add_done_callback(
-                lambda t: can_update_progress.__setitem__(0, False) if not t.result() else None
+                lambda t: can_update_progress.__setitem__(0, False) if not t.cancelled() and not t.result() else None
             )
             last_hook_call[0] = current_time
-
-    ydl_opts = {
-        'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
-        'outtmpl': temp_file,
-        'merge_output_format': 'mp4',
-        'quiet': True,
-        'no_warnings': True,
-        'progress_hooks': [progress_hook],
-        'extractor_list': ['youtube'],
-    }
-
-    # Добавляем прокси для ByeDPI, если он включён
-    if get_byedpi_enabled():
-        presets = get_byedpi_presets()
-        active_preset = next((preset for preset in presets if preset['name'] == 'Default'), None)
-        if active_preset:
-            port = active_preset['port']
-            ydl_opts['proxy'] = f"socks5://127.0.0.1:{port}"
-            ydl_opts['force_ipv4'] = True
-            ydl_opts['geo_bypass'] = True
-            logging.info(f"🟢 [ByeDPI] Используется прокси socks5://127.0.0.1:{port} для загрузки видео", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return schedule_progress_update
+
+    flights = []  # [(MediaFlight, слушатель прогресса)] — освобождаются в finally
+
+    async def fetch_video(url, prefetch):
+        # Одно видео из нескольких чатов скачивается и конвертируется один раз, каждая задача только выгружает результат
+        flight, joined = join_media_flight(url, max_duration, prefetch, chat_title, sender_info)
+        listener = make_progress_listener(url)
+        flight.listeners.add(listener)
+        flights.append((flight, listener))
+        if joined:
+            logging.info(f"🔗 Видео уже обрабатывается для другого чата, ждём результат: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            if prefetch is not None and not prefetch.done():
+                prefetch.cancel()
+        # shield: отмена одной задачи не прерывает загрузку, которую ждут другие чаты
+        return await asyncio.shield(flight.task)
+
+    async def resolve_video(url):
+        # Опережающий запрос метаданных задачи относится только к её основной ссылке
+        prefetch = job.prefetch if job.platform == 'youtube' and url == get_youtube_url(job.video_id) else None
+        # Видео уже есть в Telegram: отправляем документ по ссылке, без загрузки, конвертации и выгрузки
+        cached_media = get_cached_media(get_link_key(url), VIDEO_ENCODE_PROFILE)
+        if cached_media is not None:
+            logging.info(f"📦 Видео уже загружено в Telegram, отправляем повторно: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            if prefetch is not None and not prefetch.done():
+                prefetch.cancel()
+            return cached_media['info'], None, cached_media
+        info, final_file = await fetch_video(url, prefetch)
+        return info, final_file, None
+
+    async def refetch_video(url):
+        # Ссылка на документ устарела: забываем её и получаем файл обычным путём
+        delete_cached_media(get_link_key(url), VIDEO_ENCODE_PROFILE)
+        info, final_file = await fetch_video(url, None)
+        if not info or final_file is None:
+            raise RuntimeError("видео больше недоступно")
+        return info, final_file
+
+    async def open_ready_video(item):
+        # Файл кэша могли удалить между проверкой и открытием (очистка кэша, другой экземпляр бота) —
+        # тогда видео получаем заново. Уже открытый файл очистка не тронет
+        try:
+            return open(item[2], 'rb')
+        except FileNotFoundError:
+            logging.warning(f"⚠️ Видео пропало из кэша, загружаем заново: {item[0]} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        flight = state.media_flights.get(item[0])
+        if flight is not None and flight.task.done():
+            # Готовый результат указывает на удалённый файл — новая загрузка не должна к нему присоединяться
+            del state.media_flights[item[0]]
+        info, final_file = await fetch_video(item[0], None)
+        if not info or final_file is None:
+            raise RuntimeError("видео больше недоступно")
+        item[1], item[2] = info, final_file
+        return open(final_file, 'rb')
 
     try:
         if not shutil.which('ffmpeg'):
             logging.error(f"🔴 Ошибка: ffmpeg не найден ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
             raise FileNotFoundError("ffmpeg не найден")
 
-        logging.info(f"🎬 Начинаем обработку: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        logging.info(f"🎬 Начинаем обработку: {urls_text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
 
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'extractor_list': ['youtube']}) as ydl:
-            info = ydl.extract_info(url, download=False)
+        results = await asyncio.gather(*(resolve_video(url) for url in urls), return_exceptions=True)
+
+        # Недоступные, слишком длинные и сломавшиеся видео не мешают отправить остальные
+        ready = []  # [[url, info, final_file, cached_media]]
+        rejected_lines = []
+        has_rejected_duration = False
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                rejected_lines.append(f"Видео {url} не удалось обработать")
+                logging.error(f"🔴 Ошибка: Не удалось обработать {url} ({chat_title}, {sender_info}) - {str(result)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                continue
+            info, final_file, cached_media = result
             if not info or 'duration' not in info:
-                error_text = f"Видео {url} недоступно\n{platform}\n[BotSignature:{state.bot_signature_id}]"
-                final_text = f"{original_text}\n➖➖➖\n{error_text}"
-                if not can_edit:
-                    await state.client.delete_messages(chat_id, progress_msg.id)
-                else:
-                    await state.client.edit_message(chat_id, progress_msg.id, final_text)
-                logging.error(f"🔴 Ошибка: Видео недоступно ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return False
-            duration = info.get('duration', 0)
-            if max_duration and duration > max_duration:
-                error_text = f"Ссылка: {url}\nВидео отклонено: длительность {duration} сек > {max_duration} сек\n{platform}\n[BotSignature:{state.bot_signature_id}]"
-                final_text = f"{original_text}\n➖➖➖\n{error_text}"
-                if can_edit:
-                    await state.client.edit_message(chat_id, progress_msg.id, final_text)
-                else:
-                    responses = get_responses()
-                    if responses and state.responses_enabled:
-                        random_response = random.choice(responses)[1]
-                        await state.client.edit_message(chat_id, progress_msg.id, random_response)
-                    else:
-                        await state.client.delete_messages(chat_id, progress_msg.id)
+                rejected_lines.append(f"Видео {url} недоступно")
+                logging.error(f"🔴 Ошибка: Видео недоступно {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            elif final_file is None and cached_media is None:
+                duration = info.get('duration', 0)
+                rejected_lines.append(f"Ссылка: {url}\nВидео отклонено: длительность {duration} сек > {max_duration} сек")
+                has_rejected_duration = True
                 logging.warning(f"⚠️ Видео отклонено: длительность {duration} сек > {max_duration} сек ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return False
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            try:
-                info = ydl.extract_info(url, download=True)
-            except Exception as e:
-                logging.error(f"🔴 Ошибка: Не удалось загрузить видео {url} с помощью yt_dlp ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                raise
-            temp_file = ydl.prepare_filename(info)
-            final_file = temp_file.rsplit('.', 1)[0] + '_telegram.mp4'
-
-            ffmpeg_cmd = [
-                'ffmpeg', '-i', temp_file,
-                '-c:v', 'h264_nvenc' if state.gpu_enabled else 'libx264',
-                '-profile:v', 'baseline',
-                '-b:v', '1000k', '-maxrate', '1200k', '-bufsize', '2000k',
-                '-c:a', 'aac', '-b:a', '96k', '-ar', '44100',
-                '-vf', 'scale=720:-2,format=yuv420p',
-                '-preset', 'p4' if state.gpu_enabled else 'veryfast',
-                '-movflags', '+faststart',
-                '-y', final_file
-            ]
-            try:
-                result = subprocess.run(
-                    ffmpeg_cmd,
-                    check=True,
-                    stderr=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    text=True,
-                    creationflags=subprocess.CREATE_NO_WINDOW
-                )
-            except subprocess.CalledProcessError as e:
-                logging.error(f"🔴 Ошибка: Не удалось обработать видео {url} с помощью ffmpeg ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                if state.gpu_enabled:
-                    logging.warning(f"⚠️ GPU-режим не сработал, используется CPU ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    ffmpeg_cmd[ffmpeg_cmd.index('-c:v') + 1] = 'libx264'
-                    ffmpeg_cmd[ffmpeg_cmd.index('-preset') + 1] = 'veryfast'
-                    result = subprocess.run(
-                        ffmpeg_cmd,
-                        check=True,
-                        stderr=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        text=True,
-                        creationflags=subprocess.CREATE_NO_WINDOW
-                    )
+            else:
+                ready.append([url, info, final_file, cached_media])
+        rejected_text = "".join(f"{line}\n" for line in rejected_lines)
+
+        if not ready:
+            error_text = f"{rejected_text}{platform}\n[BotSignature:{state.bot_signature_id}]"
+            final_text = f"{rewritten_text}{original_text}\n➖➖➖\n{error_text}"
+            if can_edit or rewritten_text:
+                # Переписанные ссылки других платформ остаются в ответе, даже если видео YouTube не вышло
+                await state.client.edit_message(chat_id, progress_msg.id, final_text)
+            else:
+                responses = get_responses()
+                if has_rejected_duration and responses and state.responses_enabled:
+                    random_response = random.choice(responses)[1]
+                    await state.client.edit_message(chat_id, progress_msg.id, random_response)
                 else:
-                    raise
+                    await state.client.delete_messages(chat_id, progress_msg.id)
+            # Ни одно видео не отправлено — задача не считается выполненной, даже если переписанные ссылки ушли
+            return False
 
-            width = min(info.get('width', 720), 720)
-            height = min(info.get('height', 1280), 1280)
-            duration = info.get('duration', 0)
+        # Пока видео загружалось, ответ другого бота уже пришёл бы событием — запрос к Telegram не нужен
+        if state.signatures.get(chat_id, message_id) is not None:
+            logging.warning(f"⚠️ Ссылка обработана другим ботом: {urls_text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            if not can_edit:
+                await state.client.delete_messages(chat_id, progress_msg.id)
+            return False
 
-            start_time = time.time()
-            messages_checked = 0
-            while time.time() - start_time < 5 and messages_checked < 2:
-                new_messages = await state.client.get_messages(chat_id, min_id=message_id, limit=10)
-                for msg in new_messages:
-                    if not msg.text or msg.id <= message_id:
+        success_text = f"{rewritten_text}Исходное сообщение:\n\n{original_text}\n➖➖➖\n{rejected_text}{platform}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
+        if len(ready) == 1:
+            item = ready[0]
+            url, _, _, cached_media = item
+            sent_message = None
+            if cached_media is not None:
+                try:
+                    sent_message = await state.client.edit_message(chat_id, progress_msg.id, success_text, file=cached_media['document'])
+                except (telethon.errors.FileReferenceExpiredError, telethon.errors.MediaEmptyError) as e:
+                    logging.warning(f"⚠️ Сохранённое видео недоступно, загружаем заново: {url} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                    item[1], item[2] = await refetch_video(url)
+            if sent_message is None:
+                with await open_ready_video(item) as video:
+                    async with state.pipeline_stages['upload']:
+                        sent_message = await state.client.edit_message(
+                            chat_id,
+                            progress_msg.id,
+                            success_text,
+                            file=video,
+                            attributes=get_video_attributes(item[1]),
+                            force_document=False
+                        )
+            sent_messages = [sent_message]
+        else:
+            # Альбом отправляется одним запросом: файлы выгружаются заранее, у каждого свои размеры и длительность
+            async def send_album():
+                album = []
+                for item in ready:
+                    if item[3] is not None:
+                        album.append(item[3]['document'])
                         continue
-                    messages_checked += 1
-                    if re.search(r'\[BotSignature:[0-9a-f-]+\]', msg.text) and msg.reply_to_msg_id == message_id:
-                        signature = re.search(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]', msg.text).group(1)
-                        if signature != state.bot_signature_id:
-                            logging.warning(f"⚠️ Ссылка обработана другим ботом: {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                            if not can_edit:
-                                await state.client.delete_messages(chat_id, progress_msg.id)
-                            return False
-                await asyncio.sleep(0.5)
-
-            from telethon.tl.types import DocumentAttributeVideo
-            attributes = [
-                DocumentAttributeVideo(
-                    duration=int(duration),
-                    w=width,
-                    h=height,
-                    supports_streaming=True
-                )
-            ]
-            success_text = f"Исходное сообщение:\n\n{original_text}\n➖➖➖\n{platform}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
-            with open(final_file, 'rb') as video:
-                await state.client.edit_message(
-                    chat_id,
-                    progress_msg.id,
-                    success_text,
-                    file=video,
-                    attributes=attributes,
-                    force_document=False
-                )
-            logging.info(f"✅ YouTube: Видео успешно обработано {url} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            return True
+                    with await open_ready_video(item) as video:
+                        async with state.pipeline_stages['upload']:
+                            uploaded = await state.client.upload_file(video)
+                    album.append(InputMediaUploadedDocument(file=uploaded, mime_type='video/mp4', attributes=get_video_attributes(item[1])))
+                # Если исходное сообщение редактируется, текст с подписью остаётся в нём, а альбом идёт без подписи
+                captions = [""] * len(album) if can_edit else [success_text] + [""] * (len(album) - 1)
+                return await state.client.send_file(chat_id, album, caption=captions, reply_to=message_id)
+            try:
+                sent_messages = await send_album()
+            except (telethon.errors.FileReferenceExpiredError, telethon.errors.MediaEmptyError) as e:
+                logging.warning(f"⚠️ Сохранённые видео недоступны, загружаем заново: {urls_text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                for item in ready:
+                    if item[3] is not None:
+                        item[1], item[2] = await refetch_video(item[0])
+                        item[3] = None
+                sent_messages = await send_album()
+            # Текст с подписью — либо в исходном сообщении, либо в альбоме; сообщение прогресса больше не нужно
+            if can_edit:
+                await state.client.edit_message(chat_id, progress_msg.id, success_text)
+            else:
+                await state.client.delete_messages(chat_id, progress_msg.id)
+        # Сохраняем документы (и обновлённые file_reference) для следующих отправок этих видео
+        for (url, info, _, _), sent_message in zip(ready, sent_messages):
+            if sent_message is not None and getattr(sent_message, 'document', None) is not None:
+                save_cached_media(get_link_key(url), VIDEO_ENCODE_PROFILE, sent_message.document, info)
+        logging.info(f"✅ YouTube: Видео успешно обработано ({len(ready)}) {urls_text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return True
 
     except Exception as e:
         try:
-            error_text = f"Видео {url} недоступно или не удалось обработать\n{platform}\n[BotSignature:{state.bot_signature_id}]"
-            final_text = f"{original_text}\n➖➖➖\n{error_text}"
-            if not can_edit:
+            error_text = f"Видео {urls_text} недоступно или не удалось обработать\n{platform}\n[BotSignature:{state.bot_signature_id}]"
+            final_text = f"{rewritten_text}{original_text}\n➖➖➖\n{error_text}"
+            if not can_edit and not rewritten_text:
                 await state.client.delete_messages(chat_id, progress_msg.id)
             else:
                 await state.client.edit_message(chat_id, progress_msg.id, final_text)
         except Exception as delete_error:
-            logging.error(f"🔴 Ошибка: Не удалось удалить/отредактировать сообщение для {url} ({chat_title}, {sender_info}) - {str(delete_error)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-        logging.error(f"🔴 Ошибка: Не удалось обработать {url} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            logging.error(f"🔴 Ошибка: Не удалось удалить/отредактировать сообщение для {urls_text} ({chat_title}, {sender_info}) - {str(delete_error)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        logging.error(f"🔴 Ошибка: Не удалось обработать {urls_text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
         return False
     finally:
-        if url in state.processing_links:
-            state.processing_links.remove(url)
-        for f in [temp_file, final_file]:
-            if f and os.path.exists(f):
-                for attempt in range(3):
-                    try:
-                        os.remove(f)
-                        break
-                    except PermissionError as e:
-                        if "[WinError 32]" in str(e):
-                            await asyncio.sleep(1)
-                        else:
-                            logging.error(f"Не удалось удалить временный файл: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                            break
-                    except Exception as e:
-                        logging.error(f"Не удалось удалить временный файл: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                        break
-                else:
-                    logging.error(f"Не удалось удалить временный файл после 3 попыток: {f}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-
-async def process_video_link(chat_id, message_id, text, message):
+        for url in urls:
+            state.processing_links.discard(url)
+        for flight, listener in flights:
+            flight.listeners.discard(listener)
+            await release_media_flight(flight, chat_title, sender_info)
+
+async def process_video_link(job):
+    chat_id, message_id, text, message = job.chat_id, job.message_id, job.text, job.message
+    chat_title, sender_info, can_edit = job.chat_title, job.sender_info, job.can_edit
     platform_settings = get_platform_settings()
-
-    # Нормализация chat_id
-    normalized_chat_id = abs(chat_id)
-    if str(chat_id).startswith('-100'):
-        normalized_chat_id = int(str(chat_id)[4:])
-
-    try:
-        chat_entity = await state.client.get_entity(chat_id)
-        chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
-    except Exception as e:
-        logging.error(f"Не удалось получить chat_title: {str(e)}", extra={'chat_title': 'Неизвестный чат', 'sender_info': 'для неизвестного пользователя'})
-        chat_title = "Неизвестный чат"
-
-    try:
-        sender = await message.get_sender()
-        sender_info = f"для @{sender.username or ''} {sender.first_name or ''} {sender.last_name or ''}".strip()
-    except Exception as e:
-        logging.error(f"Не удалось получить sender_info: {str(e)}", extra={'chat_title': chat_title, 'sender_info': 'для неизвестного пользователя'})
-        sender_info = "для неизвестного пользователя"
-
-    is_forwarded = message.fwd_from is not None
-
-    # Проверяем тип чата и права на редактирование
-    if isinstance(chat_entity, Channel):
-        # Для каналов и супергрупп
-        if chat_entity.megagroup:
-            # Для супергрупп используем старую логику, если нет прав на редактирование
-            is_own_message = message.sender_id == state.current_user_id
-            can_edit = is_own_message and not is_forwarded
-            if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
-                if chat_entity.admin_rights.edit_messages:
-                    can_edit = not is_forwarded  # Если есть права, игнорируем is_own_message
-        else:
-            # Для обычных каналов проверяем права
-            can_edit = not is_forwarded
-            if hasattr(chat_entity, 'admin_rights') and chat_entity.admin_rights:
-                can_edit = chat_entity.admin_rights.edit_messages and not is_forwarded
-            else:
-                can_edit = False  # Если нет прав админа, редактировать нельзя
-    else:
-        # Для личных переписок и групп используем старую логику
-        is_own_message = message.sender_id == state.current_user_id
-        can_edit = is_own_message and not is_forwarded
+    # Задача выполняется в своём контексте: стадии конвейера видят её чат
+    current_stage_chat.set(normalize_chat_id(chat_id))
 
     # Сохраняем исходный текст сообщения, если можно редактировать
     original_text = ""
     if can_edit:
         original_text = message.text or ""
 
+    # Единственный повторный запрос сообщения: за время ожидания в очереди его мог обработать другой бот
     current_message = await state.client.get_messages(chat_id, ids=message_id)
     if current_message and re.search(r'\[BotSignature:[0-9a-f-]+\]', current_message.text or ""):
         logging.warning(f"⚠️ Ссылка уже обработана: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
         return False
 
-    recent_messages = await state.client.get_messages(chat_id, limit=3)
-    for msg in recent_messages:
-        if not msg.text:
-            continue
-        msg_text = msg.text
-        logging.debug(f"Проверка перед обработкой: {msg_text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-        link_conditions = [
-            text in msg_text,
-            ('tiktok.com' in text and text.replace('vm.tiktok.com', 'vm.vxtiktok.com') in msg_text),
-            ('tiktok.com' in text and text.replace('vt.tiktok.com', 'vm.vxtiktok.com') in msg_text),
-            ('tiktok.com' in text and 'vxtiktok.com' in msg_text and text.split('/')[-2] in msg_text),
-            ('x.com' in text and text.replace('x.com', 'fxtwitter.com') in msg_text),
-            ('twitter.com' in text and text.replace('twitter.com', 'fxtwitter.com') in msg_text),
-            ('instagram.com' in text and text.replace('instagram.com', 'ddinstagram.com') in msg_text)
-        ]
-        has_signature = re.search(r'\[BotSignature:[0-9a-f-]+\]', msg_text)
-        if any(link_conditions) and has_signature:
-            signature = re.search(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]', msg_text).group(1)
-            if signature != state.bot_signature_id:
-                logging.warning(
-                    f"⚠️ Ссылка обработана другим ботом: {text} ({chat_title}, {sender_info})",
-                    extra={'chat_title': chat_title, 'sender_info': sender_info}
-                )
-                return False
+    if state.recent_messages.find_foreign_claim(chat_id, {link[:2] for link in job.links}) is not None:
+        logging.warning(f"⚠️ Ссылка обработана другим ботом: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return False
 
     await asyncio.sleep(1)
 
-    for pattern_name, pattern in VIDEO_URL_PATTERNS.items():
-        match = pattern.search(text)
-        if not match or not platform_settings.get(pattern_name, False):
-            continue
-        video_id = match.group(1) if pattern_name != 'tiktok' else match.group(2)
-        username = match.group(1) if pattern_name == 'tiktok' and match.group(1) else None
-
-        async def check_new_messages(original_msg_id, temp_msg=None):
-            start_time = time.time()
-            messages_checked = 0
-            while time.time() - start_time < 5 and messages_checked < 2:
-                new_messages = await state.client.get_messages(chat_id, min_id=original_msg_id, limit=10)
-                for msg in new_messages:
-                    if not msg.text or msg.id <= original_msg_id:
-                        continue
-                    messages_checked += 1
-                    if re.search(r'\[BotSignature:[0-9a-f-]+\]', msg.text) and msg.reply_to_msg_id == original_msg_id:
-                        signature = re.search(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]', msg.text).group(1)
-                        if signature != state.bot_signature_id:
-                            logging.warning(f"⚠️ Ссылка обработана другим ботом: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                            if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
-                                await state.client.delete_messages(chat_id, temp_msg.id)
-                            return True
-                await asyncio.sleep(0.5)
+    async def check_foreign_claim(original_msg_id, temp_msg=None):
+        # Ожидание заканчивается сразу, как только приходит ответ другого бота, или по истечении окна
+        if await state.signatures.wait(chat_id, original_msg_id, CLAIM_WINDOW) is None:
             return False
+        logging.warning(f"⚠️ Ссылка обработана другим ботом: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
+            await state.client.delete_messages(chat_id, temp_msg.id)
+        return True
 
-        if pattern_name == 'instagram':
-            dd_url = f"https://www.ddinstagram.com/reel/{video_id}/"
-            platform_label = "Instagram 📸"
-            success_text = f"{dd_url}\n➖➖➖\nИсходное сообщение:\n\n{original_text if can_edit else text}\n➖➖➖\n{platform_label}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
-            temp_msg = None
-            try:
-                if can_edit:
-                    await state.client.edit_message(chat_id, message_id, success_text)
-                    temp_msg = message
-                else:
-                    temp_msg = await state.client.send_message(chat_id, success_text, reply_to=message_id)
-                if temp_msg is None or not hasattr(temp_msg, 'id'):
-                    logging.error(f"🔴 Ошибка: Не удалось отправить сообщение ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    return False
-
-                if await check_new_messages(message_id, temp_msg):
-                    return False
-
-                # Инкремент статистики для Instagram, так как она обрабатывается напрямую
-                state.links_processed_per_chat[normalized_chat_id] = state.links_processed_per_chat.get(normalized_chat_id, 0) + 1
-                return True
-            except Exception as e:
-                if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
-                    await state.client.delete_messages(chat_id, temp_msg.id)
-                logging.error(f"🔴 Ошибка: Не удалось обработать {dd_url} (вероятно нет видео по ссылке) ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
-                return False
-
-        elif pattern_name == 'tiktok':
-            url = match.group(0)
-            dd_url = url.replace('.tiktok.com', '.vxtiktok.com').replace('vm.tiktok.com', 'vm.vxtiktok.com').replace('vt.tiktok.com', 'vm.vxtiktok.com')
-            platform_label = "TikTok 🎵"
-            success_text = f"{dd_url}\n➖➖➖\nИсходное сообщение:\n\n{original_text if can_edit else text}\n➖➖➖\n{platform_label}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
-            temp_msg = None
-            try:
-                if can_edit:
-                    await state.client.edit_message(chat_id, message_id, success_text)
-                    temp_msg = message
-                else:
-                    temp_msg = await state.client.send_message(chat_id, success_text, reply_to=message_id)
-                if temp_msg is None or not hasattr(temp_msg, 'id'):
-                    logging.error(f"🔴 Ошибка: Не удалось отправить сообщение ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    return False
-
-                if await check_new_messages(message_id, temp_msg):
-                    logging.warning(f"⚠️ TikTok: Ссылка перехвачена другим ботом ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    return False
-
-                logging.info(f"✅ TikTok: Ссылка обработана ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return True
-            except Exception as e:
-                if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
-                    await state.client.delete_messages(chat_id, temp_msg.id)
-                logging.error(f"🔴 Ошибка: Не удалось обработать {url} (вероятно нет видео по ссылке или ошибка Telegram API) ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return False
+    # Все ссылки сообщения обрабатываются вместе: переписанные уходят одной правкой или одним ответом,
+    # видео YouTube — одним альбомом в том же ответе
+    rewrites = []  # [(платформа, переписанная ссылка)]
+    youtube_urls = []
+    platform_labels = []
+    for pattern_name, video_id, (link_start, link_end) in job.links:
+        if not platform_settings.get(pattern_name, False):
+            continue
+        if pattern_name == 'youtube':
+            url = get_youtube_url(video_id)
+            if url in youtube_urls:
+                continue
+            youtube_urls.append(url)
+        else:
+            dd_url = get_rewritten_url(pattern_name, video_id, text[link_start:link_end])
+            if any(dd_url == rewritten for _, rewritten in rewrites):
+                continue
+            rewrites.append((pattern_name, dd_url))
+        if MESSAGE_PLATFORM_LABELS[pattern_name] not in platform_labels:
+            platform_labels.append(MESSAGE_PLATFORM_LABELS[pattern_name])
 
-        elif pattern_name == 'twitter':
-            url = match.group(0)
-            dd_url = re.sub(r'^(https?://)(?:www\.)?(?:x|twitter)\.com', r'\1fxtwitter.com', url)
-            platform_label = "Twitter (X) 🐦"
-            success_text = f"{dd_url}\n➖➖➖\nИсходное сообщение:\n\n{original_text if can_edit else text}\n➖➖➖\n{platform_label}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
-            temp_msg = None
-            try:
-                if can_edit:
-                    await state.client.edit_message(chat_id, message_id, success_text)
-                    temp_msg = message
-                else:
-                    temp_msg = await state.client.send_message(chat_id, success_text, reply_to=message_id)
-                if temp_msg is None or not hasattr(temp_msg, 'id'):
-                    logging.error(f"🔴 Ошибка: Не удалось отправить сообщение ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    return False
+    if not rewrites and not youtube_urls:
+        logging.warning(f"⚠️ Ссылка не соответствует ни одной платформе: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return False
 
-                if await check_new_messages(message_id, temp_msg):
-                    logging.warning(f"⚠️ Twitter: Ссылка перехвачена другим ботом ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    return False
+    platform_label = " | ".join(platform_labels)
+    rewritten_text = "".join(f"{dd_url}\n" for _, dd_url in rewrites) + "➖➖➖\n" if rewrites else ""
+    if youtube_urls:
+        return await process_video(job, youtube_urls, platform_label, YOUTUBE_MAX_DURATION, rewritten_text)
 
-                logging.info(f"✅ Twitter: Ссылка обработана ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return True
-            except Exception as e:
-                if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
-                    await state.client.delete_messages(chat_id, temp_msg.id)
-                logging.error(f"🔴 Ошибка: Не удалось обработать {url} (вероятно нет видео по ссылке или ошибка Telegram API) ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return False
+    rewritten_names = list(dict.fromkeys(PLATFORM_LOG_NAMES[name] for name, _ in rewrites))
+    success_text = f"{rewritten_text}Исходное сообщение:\n\n{original_text if can_edit else text}\n➖➖➖\n{platform_label}\nСсылки: https://taplink.cc/drews 👈\n[BotSignature:{state.bot_signature_id}]"
+    temp_msg = None
+    try:
+        if can_edit:
+            await state.client.edit_message(chat_id, message_id, success_text)
+            temp_msg = message
+        else:
+            temp_msg = await state.client.send_message(chat_id, success_text, reply_to=message_id)
+        if temp_msg is None or not hasattr(temp_msg, 'id'):
+            logging.error(f"🔴 Ошибка: Не удалось отправить сообщение ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            return False
 
-        elif pattern_name == 'youtube':
-            original_url = match.group(0)
-            url = f"https://youtube.com/watch?v={video_id}"
-            result = await process_video(chat_id, message_id, url, "YouTube 📺", 180, message, sender_info, original_url)
-            return result  # Убираем избыточное логирование
+        if await check_foreign_claim(message_id, temp_msg):
+            for name in rewritten_names:
+                logging.warning(f"⚠️ {name}: Ссылка перехвачена другим ботом ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            return False
 
-    logging.warning(f"⚠️ Ссылка не соответствует ни одной платформе: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-    return False
+        for name in rewritten_names:
+            logging.info(f"✅ {name}: Ссылка обработана ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return True
+    except Exception as e:
+        if temp_msg and hasattr(temp_msg, 'id') and not can_edit:
+            await state.client.delete_messages(chat_id, temp_msg.id)
+        dd_urls = ", ".join(dd_url for _, dd_url in rewrites)
+        logging.error(f"🔴 Ошибка: Не удалось обработать {dd_urls} (вероятно нет видео по ссылке или ошибка Telegram API) ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+        return False
 
 async def clean_temp_files():
     check_interval = 300  # 5 минут
@@ -1187,6 +2387,9 @@ async def clean_temp_files():
                             logging.error(f"Не удалось удалить файл {file_path}: {str(e)}")
                             break
 
+        # Кэш видео не чистится по возрасту: вытесняются давно не использованные файлы сверх лимита
+        trim_video_cache()
+
         # 3. Очистка update.bat в корне программы
         if state.switch_is_on and os.path.exists(bat_path):
             # Проверяем возраст файла
@@ -1969,8 +3172,7 @@ class AuthWindow(QMainWindow):
             for task in state.active_tasks:
                 task.cancel()
             state.active_tasks.clear()
-            while not state.task_queue.empty():
-                state.task_queue.get_nowait()
+            clear_task_queues()
             state.client.remove_event_handler(self.message_handler)
             state.links_processed_per_chat.clear()
             state.errors_per_chat.clear()
@@ -3573,11 +4775,7 @@ class ChatSettingsWindow(QMainWindow, MenuBarMixin):
                 self.filter_selected_chats()
 
     def remove_all_chats(self):
-        conn = sqlite3.connect('telegram_bot_data.db')
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM selected_chats")
-        conn.commit()
-        conn.close()
+        clear_selected_chats()
         self.filter_all_chats()
         self.filter_selected_chats()
 
@@ -3742,6 +4940,7 @@ class ChatSettingsWindow(QMainWindow, MenuBarMixin):
 
     def clear_cache(self):
         state.chat_cache.clear()
+        state.entities.clear()
         state.participants_cache.clear()
         state.user_cache.clear()
         state.participant_to_chats.clear()
@@ -3832,17 +5031,8 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
             if not hasattr(self, 'task_manager_task') or self.task_manager_task.done():
                 self.task_manager_task = asyncio.create_task(self.task_manager())
                 logging.debug("Task manager запущен при восстановлении состояния")
-            if state.message_handler_registered:
-                state.client.remove_event_handler(self.message_handler)
-                logging.debug("Предыдущий message_handler удалён перед восстановлением")
-            if state.only_me_mode:
-                state.client.add_event_handler(self.message_handler, events.NewMessage())
-                self.status_label.setText("Режим: Только мои сообщения")
-            else:
-                selected_chats = [chat_id for chat_id, _, _ in get_selected_chats()]
-                state.client.add_event_handler(self.message_handler, events.NewMessage(chats=selected_chats))
-                self.status_label.setText("Бот запущен")
-            state.message_handler_registered = True
+            self.register_message_handler()
+            self.status_label.setText("Режим: Только мои сообщения" if state.only_me_mode else "Бот запущен")
             logging.info("🟢 Бот восстановлен в активное состояние")
 
         # Новые окна
@@ -4068,7 +5258,47 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
         self.current_mode_label.setAlignment(Qt.AlignCenter)
         layout.addWidget(self.current_mode_label)
 
-        layout.addSpacing(25)
+        # Количество параллельных задач
+        workers_layout = QHBoxLayout()
+        workers_layout.addStretch()
+        workers_layout.addWidget(QLabel("Параллельных загрузок YouTube:"))
+        self.worker_count_combo = QComboBox()
+        for count in range(1, MAX_WORKER_COUNT + 1):
+            self.worker_count_combo.addItem(str(count), count)
+        state.worker_count = get_worker_count()
+        state.pipeline_stages['download'].set_limit(state.worker_count)
+        self.worker_count_combo.setCurrentIndex(state.worker_count - 1)
+        workers_layout.addWidget(self.worker_count_combo)
+        workers_layout.addSpacing(20)
+        workers_layout.addWidget(QLabel("yt-dlp:"))
+        self.ytdlp_executor_combo = QComboBox()
+        self.ytdlp_executor_combo.addItem("Потоки", False)
+        self.ytdlp_executor_combo.addItem("Процессы", True)
+        state.ytdlp_use_processes = get_ytdlp_process_pool()
+        self.ytdlp_executor_combo.setCurrentIndex(1 if state.ytdlp_use_processes else 0)
+        workers_layout.addWidget(self.ytdlp_executor_combo)
+        workers_layout.addSpacing(20)
+        workers_layout.addWidget(QLabel("Кэш видео:"))
+        self.video_cache_combo = QComboBox()
+        state.video_cache_mb = get_video_cache_mb()
+        for size_mb in sorted(set(VIDEO_CACHE_SIZES_MB) | {state.video_cache_mb}):
+            self.video_cache_combo.addItem("Выкл" if not size_mb else f"{size_mb // 1024} ГБ" if size_mb >= 1024 and size_mb % 1024 == 0 else f"{size_mb} МБ", size_mb)
+        self.video_cache_combo.setCurrentIndex(self.video_cache_combo.findData(state.video_cache_mb))
+        workers_layout.addWidget(self.video_cache_combo)
+        workers_layout.addSpacing(20)
+        workers_layout.addWidget(QLabel("Ждать других ботов:"))
+        self.competitor_window_combo = QComboBox()
+        self.competitor_window_combo.setToolTip("Задержка перед обработкой чужих ссылок только в чатах, где другой бот отвечал за этот срок")
+        state.competitor_window_days = get_competitor_window_days()
+        state.competitor_last_seen = get_competitor_last_seen()
+        for days in sorted(set(COMPETITOR_WINDOWS_DAYS) | {state.competitor_window_days}):
+            self.competitor_window_combo.addItem("Всегда" if not days else f"{days} дн.", days)
+        self.competitor_window_combo.setCurrentIndex(self.competitor_window_combo.findData(state.competitor_window_days))
+        workers_layout.addWidget(self.competitor_window_combo)
+        workers_layout.addStretch()
+        layout.addLayout(workers_layout)
+
+        layout.addSpacing(15)
 
         lists_layout = QHBoxLayout()
         lists_layout.setAlignment(Qt.AlignTop)
@@ -4160,12 +5390,77 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
         self.switch_button.clicked.connect(self.toggle_switch)
         self.back_button.clicked.connect(self.show_settings_window)
         self.gpu_switch.clicked.connect(self.update_gpu_switch)
+        self.worker_count_combo.currentIndexChanged.connect(self.update_worker_count)
+        self.ytdlp_executor_combo.currentIndexChanged.connect(self.update_ytdlp_executor)
+        self.video_cache_combo.currentIndexChanged.connect(self.update_video_cache_size)
+        self.competitor_window_combo.currentIndexChanged.connect(self.update_competitor_window)
+        settings_store.changed.connect(self.on_settings_changed)
         log_button.clicked.connect(self.open_log_file)
         tasks_button.clicked.connect(self.open_tasks_window)
         stats_button.clicked.connect(self.open_detailed_stats_window)
 
         self.tab_widget.addTab(main_tab, "⚙️ Основная")
 
+    def update_worker_count(self):
+        count = self.worker_count_combo.currentData()
+        if count is None:
+            return
+        state.worker_count = count
+        state.pipeline_stages['download'].set_limit(count)
+        save_worker_count(count)
+        logging.info(f"Параллельных загрузок YouTube: {count}")
+
+    def update_ytdlp_executor(self):
+        use_processes = self.ytdlp_executor_combo.currentData()
+        if use_processes is None:
+            return
+        # Новый пул создаётся при следующей загрузке, текущие загрузки завершаются в старом
+        state.ytdlp_use_processes = use_processes
+        save_ytdlp_process_pool(use_processes)
+
+    def register_message_handler(self):
+        # Удаляем обработчик, если он уже зарегистрирован, перед новой регистрацией
+        if state.message_handler_registered:
+            state.client.remove_event_handler(self.message_handler)
+            state.client.remove_event_handler(on_chat_event)
+            logging.debug("Предыдущий message_handler удалён перед регистрацией")
+        selected_chats = None if state.only_me_mode else [chat_id for chat_id, _, _ in get_selected_chats()]
+        # Последние сообщения и подписи других ботов — из новых сообщений и правок, в том числе ответов на наши ссылки.
+        # Регистрируется первым: к проверке ссылки в message_handler сообщение уже в RecentMessages
+        state.client.add_event_handler(on_chat_event, events.NewMessage(chats=selected_chats))
+        state.client.add_event_handler(on_chat_event, events.MessageEdited(chats=selected_chats))
+        if state.only_me_mode:
+            # Чужие сообщения отсекает сам Telethon, до вызова обработчика
+            state.client.add_event_handler(self.message_handler, events.NewMessage(outgoing=True))
+        else:
+            state.client.add_event_handler(self.message_handler, events.NewMessage(chats=selected_chats))
+        state.message_handler_registered = True
+
+    def on_settings_changed(self, section):
+        if section == 'selected_chats':
+            self.update_chats_stats()
+            # Фильтр NewMessage(chats=...) фиксируется при регистрации — обновляем его без перезапуска бота
+            if state.message_handler_registered and not state.only_me_mode:
+                self.register_message_handler()
+                logging.info("Список отслеживаемых чатов обновлён")
+
+    def update_video_cache_size(self):
+        size_mb = self.video_cache_combo.currentData()
+        if size_mb is None:
+            return
+        state.video_cache_mb = size_mb
+        save_video_cache_mb(size_mb)
+        trim_video_cache()
+        logging.info(f"Кэш видео: {self.video_cache_combo.currentText()}")
+
+    def update_competitor_window(self):
+        days = self.competitor_window_combo.currentData()
+        if days is None:
+            return
+        state.competitor_window_days = days
+        save_competitor_window_days(days)
+        logging.info(f"Ждать других ботов: {self.competitor_window_combo.currentText()}")
+
     def open_log_file(self):
         log_file_path = "bot.log"
         if os.path.exists(log_file_path):
@@ -4184,6 +5479,14 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
             self.stats_window.show()
 
     def closeEvent(self, event):
+        if hasattr(self, 'task_manager_task'):
+            self.task_manager_task.cancel()
+        flush_job_journal()
+        # Окно пересоздаётся при каждом возврате из настроек — закрытая панель не должна получать изменения настроек
+        try:
+            settings_store.changed.disconnect(self.on_settings_changed)
+        except (RuntimeError, TypeError):
+            pass
         if self.tasks_window:
             self.tasks_window.close()
         if self.stats_window:
@@ -4657,6 +5960,7 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
         self.update_switch_state()
         if state.switch_is_on:
             self.uptime_seconds = 0
+            state.entities.clear()  # Права и названия могли измениться, пока бот был выключен
             self.uptime_timer.start(1000)
             self.log_list.clear()
             # Инициализируем словари с нормализованными chat_id, если пусты
@@ -4669,20 +5973,9 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
                         state.links_processed_per_chat[normalized_chat_id] = 0
                         state.errors_per_chat[normalized_chat_id] = 0
             self.update_chats_stats()
-            # Удаляем обработчик, если он уже зарегистрирован, перед новой регистрацией
-            if state.message_handler_registered:
-                state.client.remove_event_handler(self.message_handler)
-                logging.debug("Предыдущий message_handler удалён перед включением")
-            if state.only_me_mode:
-                state.client.add_event_handler(self.message_handler, events.NewMessage())
-                self.status_label.setText("Режим: Только мои сообщения")
-                logging.info("🟢 Бот запущен")
-            else:
-                selected_chats = [chat_id for chat_id, _, _ in get_selected_chats()]
-                state.client.add_event_handler(self.message_handler, events.NewMessage(chats=selected_chats))
-                self.status_label.setText("Бот запущен")
-                logging.info("🟢 Бот запущен")
-            state.message_handler_registered = True
+            self.register_message_handler()
+            self.status_label.setText("Режим: Только мои сообщения" if state.only_me_mode else "Бот запущен")
+            logging.info("🟢 Бот запущен")
             # Запускаем task_manager если он не активен
             if not hasattr(self, 'task_manager_task') or self.task_manager_task.done():
                 self.task_manager_task = asyncio.create_task(self.task_manager())
@@ -4692,10 +5985,10 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
             for task in state.active_tasks:
                 task.cancel()
             state.active_tasks.clear()
-            while not state.task_queue.empty():
-                state.task_queue.get_nowait()
+            clear_task_queues()
             if state.message_handler_registered:
                 state.client.remove_event_handler(self.message_handler)
+                state.client.remove_event_handler(on_chat_event)
                 state.message_handler_registered = False
                 logging.debug("message_handler удалён при выключении")
             self.status_label.setText("Бот выключен")
@@ -4708,7 +6001,7 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
         hours, remainder = divmod(self.uptime_seconds, 3600)
         minutes, seconds = divmod(remainder, 60)
         total_active = len(state.active_tasks)
-        total_queued = state.task_queue.qsize()
+        total_queued = sum(queue.qsize() for queue in state.task_queues.values())
         self.uptime_label.setText(f"Время работы: ⏰ {hours:02d}:{minutes:02d}:{seconds:02d} | Задачи: {total_active}/{total_queued}")
         self.update_task_indicators()
 
@@ -4795,273 +6088,263 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
         message = event.message
         text = message.text or ""
 
-        normalized_chat_id = abs(chat_id)
-        if str(chat_id).startswith('-100'):
-            normalized_chat_id = int(str(chat_id)[4:])
+        drop_reason, links = prefilter_message(chat_id, message, text)
+        if drop_reason is not None:
+            state.prefilter_drops[drop_reason] += 1
+            if drop_reason == 'rewritten':
+                chat_title = state.entities.peek_chat_title(chat_id)
+                sender_info = state.entities.peek_sender_info(message.sender_id)
+                platform = next(label for marker, label in REWRITTEN_LINK_MARKERS if marker in text)
+                logging.warning(f"⚠️ Обработанная ссылка пропущена ({platform}): {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            return
+        state.prefilter_drops['passed'] += 1
+        platform_name = links[0][0]
+        link_key = links[0][:2]
 
         try:
-            chat_entity = await state.client.get_entity(chat_id)
-            chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
+            _, chat_title = await state.entities.get_chat(chat_id)
         except Exception as e:
             chat_title = str(chat_id)
 
         try:
-            sender = await message.get_sender()
-            sender_info = f"для @{sender.username or ''} {sender.first_name or ''} {sender.last_name or ''}".strip()
+            sender_info = await state.entities.get_sender_info(message)
         except Exception:
             sender_info = "для неизвестного пользователя"
 
-        if text.startswith("Ошибка обработки") and message.sender_id == state.current_user_id:
-            logging.debug(f"Игнорируем своё сообщение об ошибке: {text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            return
-
-        if "vm.vxtiktok.com" in text or "vt.vxtiktok.com" in text or "vxtiktok.com" in text:
-            logging.warning(f"⚠️ Обработанная ссылка пропущена (TikTok): {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            return
-
-        if "fxtwitter.com" in text:
-            logging.warning(f"⚠️ Обработанная ссылка пропущена (Twitter): {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            return
-
-        if "ddinstagram.com" in text:
-            logging.warning(f"⚠️ Обработанная ссылка пропущена (Instagram): {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            return
-
         signature_match = re.search(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]', text)
         if signature_match:
             signature_id = signature_match.group(1)
             if signature_id != state.bot_signature_id:
                 logging.debug(f"Сообщение от другого бота: {signature_id}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                platform = None
-                for name, pattern in VIDEO_URL_PATTERNS.items():
-                    if pattern.search(text):
-                        platform = {"youtube": "YouTube 📺", "tiktok": "TikTok 🎵", "twitter": "Twitter 🐦", "instagram": "Instagram 📸"}.get(name)
-                        break
-                if platform:
-                    item = QListWidgetItem(f"⚠️ {platform}: {text} (Перехвачено другим ботом)")
-                    self.task_list_widget.addItem(item)
-                return
-            return
-
-        if state.only_me_mode:
-            if message.sender_id != state.current_user_id:
-                logging.debug(f"Сообщение игнорируется (режим 'Только мои сообщения'): {text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                return
-        else:
-            if not state.switch_is_on or normalized_chat_id not in {abs(cid) if not str(cid).startswith('-100') else int(str(cid)[4:]) for cid, _, _ in get_selected_chats()} or not text:
-                return
-
-        link_found = False
-        platform_name = None
-        for name, pattern in VIDEO_URL_PATTERNS.items():
-            if pattern.search(text):
-                link_found = True
-                platform_name = name
-                break
-        if not link_found:
+                item = QListWidgetItem(f"⚠️ {PLATFORM_LABELS[platform_name]}: {text} (Перехвачено другим ботом)")
+                self.task_list_widget.addItem(item)
+                # Ссылку ещё проверяем — пробный запрос метаданных можно остановить сразу, не дожидаясь конца задержки
+                claimed_job = state.jobs.find(chat_id, link_key)
+                if claimed_job is not None and claimed_job.stage == 'pending':
+                    cancel_prefetch(claimed_job)
             return
 
         is_own_message = message.sender_id == state.current_user_id
 
-        # Проверка на дублирование
-        if any(task_data[2] == text for task_data in state.task_queue_items.values()) or \
-           any(task._coro.cr_frame.f_locals.get('text', '') == text for task in state.active_tasks if task._coro.cr_code.co_name == 'process_video_link'):
+        # Проверка на дублирование по (платформа, id видео)
+        if state.jobs.find(chat_id, link_key):
             logging.debug(f"Ссылка уже в обработке или очереди: {text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
             return
+        # Задача регистрируется сразу, чтобы повтор ссылки во время задержки тоже считался дубликатом
+        job = Job(chat_id, message, text, links, chat_title, sender_info)
+        state.jobs.add(job)
+        if platform_name == 'youtube' and get_platform_settings().get('youtube', False) and needs_youtube_probe(link_key):
+            job.prefetch = asyncio.create_task(prefetch_youtube_info(get_youtube_url(job.video_id)))
 
         if is_own_message:
-            state.processing_links.add(text)
-            if platform_name == 'instagram':
-                try:
-                    await process_video_link(chat_id, message.id, text, message)
-                    item = QListWidgetItem(f"✅ Instagram 📸: {text} (Завершено)")
-                    self.task_list_widget.addItem(item)
-                except Exception as e:
-                    logging.error(f"🔴 Ошибка: Не удалось обработать {text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
-                    item = QListWidgetItem(f"🔴 Instagram 📸: {text} (Ошибка)")
-                    self.task_list_widget.addItem(item)
-                finally:
-                    if text in state.processing_links:
-                        state.processing_links.remove(text)
-                    self.update_chats_stats()
-            else:
-                task_id = str(uuid.uuid4())
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                state.task_queue_items[task_id] = (chat_id, message.id, text, message, timestamp)
-                logging.info(f"⏳ В очередь: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                await state.task_queue.put((chat_id, message.id, text, message))
-                self.update_task_indicators()
+            await self.enqueue_job(job)
             return
 
-        await asyncio.sleep(1 + random.randint(0, 5))
+        enqueue = False
+        try:
+            # В чатах без других ботов задержка только замедляет ответ
+            if is_chat_contested(chat_id):
+                await asyncio.sleep(1 + random.randint(0, 5))
+            # Задачу могли удалить из окна задач во время задержки
+            enqueue = state.jobs.get(job.id) is job and not self.is_link_claimed(job)
+        finally:
+            if not enqueue:
+                # Ссылку забрал другой бот: пробный запрос метаданных больше не нужен
+                cancel_prefetch(job)
+                state.jobs.remove(job)
+        if enqueue:
+            await self.enqueue_job(job)
+
+    def is_link_claimed(self, job):
+        if state.recent_messages.find_foreign_claim(job.chat_id, {link[:2] for link in job.links}) is None:
+            return False
+        logging.warning(f"⚠️ Ссылка обработана другим ботом: {job.text} ({job.chat_title}, {job.sender_info})", extra={'chat_title': job.chat_title, 'sender_info': job.sender_info})
+        item = QListWidgetItem(f"⚠️ {PLATFORM_LABELS[job.platform]}: {job.text} (Перехвачено другим ботом)")
+        self.task_list_widget.addItem(item)
+        return True
 
-        recent_messages = await state.client.get_messages(chat_id, limit=3)
-        link_processed = False
-        for msg in recent_messages:
-            if not msg.text:
-                continue
-            msg_text = msg.text
-            logging.debug(f"Проверка сообщения: {msg_text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            link_conditions = [
-                text in msg_text,
-                (platform_name == 'tiktok' and text.replace('vm.tiktok.com', 'vm.vxtiktok.com') in msg_text),
-                (platform_name == 'tiktok' and text.replace('vt.tiktok.com', 'vm.vxtiktok.com') in msg_text),
-                (platform_name == 'tiktok' and 'vxtiktok.com' in msg_text and text.split('/')[-2] in msg_text),
-                (platform_name == 'twitter' and text.replace('x.com', 'fxtwitter.com') in msg_text),
-                (platform_name == 'twitter' and text.replace('twitter.com', 'fxtwitter.com') in msg_text),
-                (platform_name == 'instagram' and text.replace('instagram.com', 'ddinstagram.com') in msg_text)
-            ]
-            has_signature = re.search(r'\[BotSignature:[0-9a-f-]+\]', msg_text)
-            logging.debug(f"Условия ссылки: {link_conditions}, Наличие сигнатуры: {bool(has_signature)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            if any(link_conditions) and has_signature:
-                signature = re.search(r'\[BotSignature:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\]', msg_text).group(1)
-                if signature != state.bot_signature_id:
-                    logging.warning(f"⚠️ Ссылка обработана другим ботом: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    platform = {"youtube": "YouTube 📺", "tiktok": "TikTok 🎵", "twitter": "Twitter 🐦", "instagram": "Instagram 📸"}.get(platform_name)
-                    item = QListWidgetItem(f"⚠️ {platform}: {text} (Перехвачено другим ботом)")
-                    self.task_list_widget.addItem(item)
-                    link_processed = True
-                    break
+    async def enqueue_job(self, job):
+        # Перезапись ссылок (TikTok, Twitter, Instagram) идёт в быструю очередь, YouTube — в очередь загрузки
+        state.processing_links.add(job.text)
+        await build_job_context(job)
+        if state.jobs.get(job.id) is not job:
+            # Задачу отменили, пока собирался контекст: в очередь её не ставим
+            state.processing_links.discard(job.text)
+            return
+        job.stage = 'queued'
+        journal_job(job)
+        logging.info(f"⏳ В очередь: {job.text} ({job.chat_title}, {job.sender_info})", extra={'chat_title': job.chat_title, 'sender_info': job.sender_info})
+        await state.task_queues[job.lane].put(job)
+        self.update_task_indicators()
 
-        if link_processed:
+    async def task_manager(self):
+        # Пул воркеров на каждую очередь: воркеры сами забирают задачи из state.task_queues[lane],
+        # поэтому долгие загрузки YouTube не задерживают перезапись ссылок
+        workers = {}
+        replay_task = None
+        queue_warning_shown = False
+        replayed = False
+        try:
+            while True:
+                # Восстанавливаем сохранённую очередь при запуске и после каждого включения бота
+                if state.switch_is_on and not replayed:
+                    replay_task = asyncio.create_task(self.replay_saved_jobs())
+                replayed = state.switch_is_on
+                for lane in TASK_LANES:
+                    for worker_index in range(get_lane_worker_count(lane)):
+                        key = (lane, worker_index)
+                        if key not in workers or workers[key].done():
+                            workers[key] = asyncio.create_task(self.task_worker(lane, worker_index))
+                for key in [key for key, worker in workers.items() if key[1] >= get_lane_worker_count(key[0]) and worker.done()]:
+                    del workers[key]
+
+                queue_size = sum(queue.qsize() for queue in state.task_queues.values())
+                if queue_size > 50 and not queue_warning_shown:
+                    logging.warning(f"⚠️ Очередь > 50: {queue_size} (unknown, system)", extra={'chat_title': 'unknown', 'sender_info': 'system'})
+                queue_warning_shown = queue_size > 50
+                flush_job_journal()
+                await asyncio.sleep(0.5)
+        finally:
+            # Пул принадлежит окну: при закрытии панели его воркеры и восстановление очереди останавливаются,
+            # иначе каждая новая панель добавляла бы ещё один пул к тем же очередям
+            if replay_task is not None:
+                replay_task.cancel()
+            for worker in workers.values():
+                worker.cancel()
+
+    async def replay_saved_jobs(self):
+        flush_job_journal()
+        saved_jobs = get_saved_jobs()
+        if not saved_jobs:
             return
+        jobs_by_chat = {}
+        for chat_id, message_id, url, created_at in saved_jobs:
+            jobs_by_chat.setdefault(chat_id, []).append((message_id, url, created_at))
 
-        state.processing_links.add(text)
-        if platform_name == 'instagram':
+        restored = 0
+        for chat_id, entries in jobs_by_chat.items():
             try:
-                await process_video_link(chat_id, message.id, text, message)
-                item = QListWidgetItem(f"✅ Instagram 📸: {text} (Завершено)")
-                self.task_list_widget.addItem(item)
+                _, chat_title = await state.entities.get_chat(chat_id)
+            except Exception:
+                chat_title = str(chat_id)
+            for start in range(0, len(entries), JOB_REPLAY_BATCH_SIZE):
+                batch = entries[start:start + JOB_REPLAY_BATCH_SIZE]
+                try:
+                    # Одним запросом получаем до JOB_REPLAY_BATCH_SIZE сообщений чата
+                    messages = await state.client.get_messages(chat_id, ids=[message_id for message_id, _, _ in batch])
+                except Exception as e:
+                    # Задачи остаются в таблице до следующего запуска
+                    logging.error(f"Не удалось восстановить задачи чата {chat_title}: {str(e)}", extra={'chat_title': chat_title, 'sender_info': 'system'})
+                    continue
+                for (message_id, _, created_at), message in zip(batch, messages):
+                    text = message.text or "" if message is not None else ""
+                    links = scan_video_links(text)
+                    if not links:
+                        # Сообщение удалено или ссылку из него убрали — восстанавливать нечего
+                        unjournal_job(chat_id, message_id)
+                        continue
+                    if not state.switch_is_on:
+                        continue
+                    claimed_job = state.jobs.find(chat_id, links[0][:2])
+                    if claimed_job is not None:
+                        # Та же ссылка уже обрабатывается — повтор не нужен. Если это то же сообщение,
+                        # строка принадлежит живой задаче и нужна для восстановления после сбоя
+                        if claimed_job.message_id != message_id:
+                            unjournal_job(chat_id, message_id)
+                        continue
+                    try:
+                        sender_info = await state.entities.get_sender_info(message)
+                    except Exception:
+                        sender_info = "для неизвестного пользователя"
+                    job = Job(chat_id, message, text, links, chat_title, sender_info)
+                    job.created_at = created_at
+                    state.jobs.add(job)
+                    await self.enqueue_job(job)
+                    restored += 1
+        if restored:
+            logging.info(f"♻️ Восстановлено задач из сохранённой очереди: {restored}")
+
+    async def task_worker(self, lane, worker_index):
+        # Воркер завершается сам, если размер пула уменьшили
+        while worker_index < get_lane_worker_count(lane):
+            if not state.switch_is_on:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                # Тайм-аут нужен, чтобы воркер замечал изменение размера пула и замену очереди
+                job = await asyncio.wait_for(state.task_queues[lane].get(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+
+            text = job.text
+            normalized_chat_id = normalize_chat_id(job.chat_id)
+            chat_title = job.chat_title
+            sender_info = job.sender_info
+
+            task = asyncio.create_task(process_video_link(job))
+            worker_cancelled = False
+            job.task = task
+            job.stage = 'running'
+            job.started_at = time.time()
+            state.active_tasks.append(task)
+            self.update_task_indicators()
+            try:
+                # Задачи видео ограничены тайм-аутами стадий конвейера: время ожидания места в стадии не считается
+                success = await run_with_timeout(task, TASK_TIMEOUT if job.lane == 'rewrite' else None)
+                if success:
+                    state.links_processed_per_chat[normalized_chat_id] = state.links_processed_per_chat.get(normalized_chat_id, 0) + 1
+                    logging.info(f"✅ Задача завершена: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                else:
+                    state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
+                    logging.error(f"🔴 Ошибка: Задача не удалась {text} ({chat_title}, {sender_info}) - Возвращено False", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # Остановлен сам воркер (панель закрыта): задача остаётся в сохранённой очереди
+                    worker_cancelled = True
+                    raise
+                logging.debug(f"Задача отменена: {text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
+            except telethon.errors.FloodWaitError as e:
+                wait_time = e.seconds
+                logging.info(f"Спим {wait_time} секунд из-за FloodWaitError", extra={'chat_title': chat_title, 'sender_info': sender_info})
+                await asyncio.sleep(wait_time)
             except Exception as e:
-                logging.error(f"🔴 Ошибка: Не удалось обработать {text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
                 state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
-                item = QListWidgetItem(f"🔴 Instagram 📸: {text} (Ошибка)")
-                self.task_list_widget.addItem(item)
+                logging.error(f"🔴 Ошибка: Общая ошибка {text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
             finally:
+                if task in state.active_tasks:
+                    state.active_tasks.remove(task)
                 if text in state.processing_links:
                     state.processing_links.remove(text)
+                state.jobs.remove(job)
+                cancel_prefetch(job)
+                # При выключении бота прерванная задача остаётся в таблице jobs и будет выполнена после запуска
+                if state.switch_is_on and not worker_cancelled:
+                    unjournal_job(job.chat_id, job.message_id)
                 self.update_chats_stats()
-        else:
-            task_id = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            state.task_queue_items[task_id] = (chat_id, message.id, text, message, timestamp)
-            logging.info(f"⏳ В очередь: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-            await state.task_queue.put((chat_id, message.id, text, message))
-            self.update_task_indicators()
-
-    async def task_manager(self):
-        while True:
-            for task in state.active_tasks[:]:
-                if task.done():
-                    state.active_tasks.remove(task)
-                    self.update_task_indicators()
-
-            if state.switch_is_on and len(state.active_tasks) < 5 and not state.task_queue.empty():
-                chat_id, message_id, text, message = await state.task_queue.get()
-                normalized_chat_id = abs(chat_id)
-                if str(chat_id).startswith('-100'):
-                    normalized_chat_id = int(str(chat_id)[4:])
-
-                try:
-                    chat_entity = await state.client.get_entity(chat_id)
-                    chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
-                except Exception:
-                    chat_title = str(chat_id)
-                try:
-                    sender = await message.get_sender()
-                    sender_info = f"для @{sender.username or ''} {sender.first_name or ''} {sender.last_name or ''}".strip()
-                except Exception:
-                    sender_info = "для неизвестного пользователя"
-
-                task = asyncio.create_task(process_video_link(chat_id, message_id, text, message))
-                state.active_tasks.append(task)
-                try:
-                    success = await run_with_timeout(task, 300)
-                    if success:
-                        state.links_processed_per_chat[normalized_chat_id] = state.links_processed_per_chat.get(normalized_chat_id, 0) + 1
-                        logging.info(f"✅ Задача завершена: {text} ({chat_title}, {sender_info})", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    else:
-                        state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
-                        logging.error(f"🔴 Ошибка: Задача не удалась {text} ({chat_title}, {sender_info}) - Возвращено False", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                except asyncio.CancelledError:
-                    logging.debug(f"Задача отменена: {text}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                except telethon.errors.FloodWaitError as e:
-                    wait_time = e.seconds
-                    logging.info(f"Спим {wait_time} секунд из-за FloodWaitError", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                    await asyncio.sleep(wait_time)
-                except Exception as e:
-                    state.errors_per_chat[normalized_chat_id] = state.errors_per_chat.get(normalized_chat_id, 0) + 1
-                    logging.error(f"🔴 Ошибка: Общая ошибка {text} ({chat_title}, {sender_info}) - {str(e)}", extra={'chat_title': chat_title, 'sender_info': sender_info})
-                finally:
-                    if task in state.active_tasks:
-                        state.active_tasks.remove(task)
-                    if text in state.processing_links:
-                        state.processing_links.remove(text)
-                    # Удаляем задачу из task_queue_items, если она там есть
-                    for task_id, task_data in list(state.task_queue_items.items()):
-                        if task_data[2] == text:
-                            del state.task_queue_items[task_id]
-                            break
-                    self.update_chats_stats()
-                    self.update_task_indicators()
-                    await asyncio.sleep(3)
-                if state.task_queue.qsize() > 50:
-                    logging.warning(f"⚠️ Очередь > 50: {state.task_queue.qsize()} (unknown, system)", extra={'chat_title': 'unknown', 'sender_info': 'system'})
-            await asyncio.sleep(0.1)
+                self.update_task_indicators()
+            # Пауза только для этого воркера загрузки, остальные продолжают работу
+            if lane == 'media':
+                await asyncio.sleep(3)
 
     def update_task_indicators(self):
-        youtube_active = youtube_queued = tiktok_active = tiktok_queued = twitter_active = twitter_queued = instagram_active = instagram_queued = 0
+        active_counts = {platform: 0 for platform in PLATFORM_LABELS}
+        queued_counts = {platform: 0 for platform in PLATFORM_LABELS}
         self.task_list_widget.clear()
-        displayed_links = set()  # Для отслеживания уже добавленных ссылок
 
-        # Активные задачи
-        for task in state.active_tasks:
-            coro = task._coro
-            if coro.cr_code.co_name == 'process_video_link':
-                text = coro.cr_frame.f_locals.get('text', '')
-                if text in displayed_links:
-                    continue  # Пропускаем, если ссылка уже отображена
-                displayed_links.add(text)
-                chat_id = coro.cr_frame.f_locals.get('chat_id', 'N/A')
-                platform = None
-                if VIDEO_URL_PATTERNS['youtube'].search(text):
-                    youtube_active += 1
-                    platform = "YouTube 📺"
-                elif VIDEO_URL_PATTERNS['tiktok'].search(text):
-                    tiktok_active += 1
-                    platform = "TikTok 🎵"
-                elif VIDEO_URL_PATTERNS['twitter'].search(text):
-                    twitter_active += 1
-                    platform = "Twitter 🐦"
-                elif VIDEO_URL_PATTERNS['instagram'].search(text):
-                    instagram_active += 1
-                    platform = "Instagram 📸"
-                if platform:
-                    item = QListWidgetItem(f"🎥 {platform}: {text} (Обработка) | Chat ID: {chat_id}")
-                    self.task_list_widget.addItem(item)
-
-        # Задачи в очереди
-        for task_id, (chat_id, _, text, _, timestamp) in state.task_queue_items.items():
-            if text in displayed_links:
-                continue  # Пропускаем, если ссылка уже отображена
-            displayed_links.add(text)
-            platform = None
-            if VIDEO_URL_PATTERNS['youtube'].search(text):
-                youtube_queued += 1
-                platform = "YouTube 📺"
-            elif VIDEO_URL_PATTERNS['tiktok'].search(text):
-                tiktok_queued += 1
-                platform = "TikTok 🎵"
-            elif VIDEO_URL_PATTERNS['twitter'].search(text):
-                twitter_queued += 1
-                platform = "Twitter 🐦"
-            elif VIDEO_URL_PATTERNS['instagram'].search(text):
-                instagram_queued += 1
-                platform = "Instagram 📸"
-            if platform:
-                item = QListWidgetItem(f"⏳ {platform}: {text} (Ожидание) | Chat ID: {chat_id} | Добавлено: {timestamp}")
-                self.task_list_widget.addItem(item)
+        # Активные задачи, затем задачи в очереди — из таблицы задач
+        for job in state.jobs.with_stage('running'):
+            active_counts[job.platform] += 1
+            item = QListWidgetItem(f"🎥 {PLATFORM_LABELS[job.platform]}: {job.text} (Обработка) | Chat ID: {job.chat_id}")
+            self.task_list_widget.addItem(item)
+        for job in state.jobs.with_stage('queued'):
+            queued_counts[job.platform] += 1
+            timestamp = datetime.fromtimestamp(job.created_at).strftime("%Y-%m-%d %H:%M:%S")
+            item = QListWidgetItem(f"⏳ {PLATFORM_LABELS[job.platform]}: {job.text} (Ожидание) | Chat ID: {job.chat_id} | Добавлено: {timestamp}")
+            self.task_list_widget.addItem(item)
+
+        youtube_active, youtube_queued = active_counts['youtube'], queued_counts['youtube']
+        tiktok_active, tiktok_queued = active_counts['tiktok'], queued_counts['tiktok']
+        twitter_active, twitter_queued = active_counts['twitter'], queued_counts['twitter']
 
         self.youtube_task_indicator.setText(f"📺 {youtube_active}/{youtube_queued}")
         self.youtube_progress.setValue(youtube_active + youtube_queued)
@@ -5209,6 +6492,7 @@ class ControlPanelWindow(QMainWindow, MenuBarMixin):
             state.active_tasks.clear()
             if state.message_handler_registered:
                 state.client.remove_event_handler(self.message_handler)
+                state.client.remove_event_handler(on_chat_event)
                 state.message_handler_registered = False
                 logging.debug("message_handler удалён при переходе к настройкам")
             logging.info("Все задачи остановлены, обработчик событий удалён")
@@ -5331,6 +6615,20 @@ class TasksWindow(QMainWindow):
 
         self.task_list = QListWidget()
         layout.addWidget(self.task_list)
+        # Строки списка по ID задачи: перерисовываются только изменившиеся
+        self.rows = {}
+
+        clear_queue_button = QPushButton("Очистить очередь")
+        clear_queue_button.clicked.connect(self.clear_queue)
+        layout.addWidget(clear_queue_button)
+
+        # Доля обработки и ожидание по чатам
+        chat_share_label = QLabel("Очередь по чатам")
+        chat_share_label.setStyleSheet("font-weight: bold;")
+        layout.addWidget(chat_share_label)
+        self.chat_share_list = QListWidget()
+        self.chat_share_list.setFixedHeight(150)
+        layout.addWidget(self.chat_share_list)
 
         self.update_timer = QTimer()
         self.update_timer.timeout.connect(self.update_tasks)
@@ -5338,136 +6636,105 @@ class TasksWindow(QMainWindow):
 
         self.update_tasks()
 
-    def update_tasks(self):
-        self.task_list.clear()
-        displayed_links = set()
-
-        # Активные задачи
-        for task in state.active_tasks:
-            coro = task._coro
-            if coro.cr_code.co_name == 'process_video_link':
-                text = coro.cr_frame.f_locals.get('text', '')
-                if text in displayed_links:
-                    continue
-                displayed_links.add(text)
-                chat_id = coro.cr_frame.f_locals.get('chat_id', 'N/A')
-                platform = None
-                if VIDEO_URL_PATTERNS['youtube'].search(text):
-                    platform = "YouTube 📺"
-                elif VIDEO_URL_PATTERNS['tiktok'].search(text):
-                    platform = "TikTok 🎵"
-                elif VIDEO_URL_PATTERNS['twitter'].search(text):
-                    platform = "Twitter 🐦"
-                elif VIDEO_URL_PATTERNS['instagram'].search(text):
-                    platform = "Instagram 📸"
-                if platform:
-                    item_widget = QWidget()
-                    item_layout = QHBoxLayout(item_widget)
-                    label = QLabel(f"🎥 {platform}: {text} (Обработка) | Chat ID: {chat_id}")
-                    delete_button = QPushButton("Удалить")
-                    delete_button.setFixedSize(80, 30)
-                    delete_button.clicked.connect(lambda _, t=task: self.delete_task(t, None))
-                    item_layout.addWidget(label)
-                    item_layout.addStretch()
-                    item_layout.addWidget(delete_button)
-                    list_item = QListWidgetItem(self.task_list)
-                    list_item.setSizeHint(item_widget.sizeHint())
-                    self.task_list.addItem(list_item)
-                    self.task_list.setItemWidget(list_item, item_widget)
-
-        # Задачи в очереди
-        for task_id, (chat_id, _, text, _, timestamp) in state.task_queue_items.items():
-            if text in displayed_links:
-                continue
-            displayed_links.add(text)
-            platform = None
-            if VIDEO_URL_PATTERNS['youtube'].search(text):
-                platform = "YouTube 📺"
-            elif VIDEO_URL_PATTERNS['tiktok'].search(text):
-                platform = "TikTok 🎵"
-            elif VIDEO_URL_PATTERNS['twitter'].search(text):
-                platform = "Twitter 🐦"
-            elif VIDEO_URL_PATTERNS['instagram'].search(text):
-                platform = "Instagram 📸"
-            if platform:
-                item_widget = QWidget()
-                item_layout = QHBoxLayout(item_widget)
-                label = QLabel(f"⏳ {platform}: {text} (Ожидание) | Chat ID: {chat_id} | Добавлено: {timestamp}")
-                delete_button = QPushButton("Удалить")
-                delete_button.setFixedSize(80, 30)
-                delete_button.clicked.connect(lambda _, tid=task_id: self.delete_task(None, tid))
-                item_layout.addWidget(label)
-                item_layout.addStretch()
-                item_layout.addWidget(delete_button)
-                list_item = QListWidgetItem(self.task_list)
-                list_item.setSizeHint(item_widget.sizeHint())
-                self.task_list.addItem(list_item)
-                self.task_list.setItemWidget(list_item, item_widget)
-
-    def delete_task(self, task, task_id):
-        # Переменные для логирования
-        text = None
-        chat_title = "unknown"
-        sender_info = "system"
-
-        if task:  # Активная задача
-            coro = task._coro
-            if coro.cr_code.co_name == 'process_video_link':
-                text = coro.cr_frame.f_locals.get('text', '')
-                chat_id = coro.cr_frame.f_locals.get('chat_id', 'N/A')
-                message = coro.cr_frame.f_locals.get('message', None)
-                try:
-                    chat_entity = asyncio.get_event_loop().run_until_complete(
-                        state.client.get_entity(chat_id)
-                    )
-                    chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
-                except Exception:
-                    chat_title = str(chat_id)
-                try:
-                    sender = asyncio.get_event_loop().run_until_complete(
-                        message.get_sender()
-                    )
-                    sender_info = f"для @{sender.username or ''} {sender.first_name or ''} {sender.last_name or ''}".strip()
-                except Exception:
-                    sender_info = "для неизвестного пользователя"
-            task.cancel()
-            if task in state.active_tasks:
-                state.active_tasks.remove(task)
-
-        elif task_id:  # Задача в очереди
-            if task_id in state.task_queue_items:
-                chat_id, _, text, message, _ = state.task_queue_items[task_id]
-                try:
-                    chat_entity = asyncio.get_event_loop().run_until_complete(
-                        state.client.get_entity(chat_id)
-                    )
-                    chat_title = chat_entity.title if hasattr(chat_entity, 'title') else f"{chat_entity.first_name or ''} {chat_entity.last_name or ''}".strip()
-                except Exception:
-                    chat_title = str(chat_id)
-                try:
-                    sender = asyncio.get_event_loop().run_until_complete(
-                        message.get_sender()
-                    )
-                    sender_info = f"для @{sender.username or ''} {sender.first_name or ''} {sender.last_name or ''}".strip()
-                except Exception:
-                    sender_info = "для неизвестного пользователя"
-                del state.task_queue_items[task_id]
-                new_queue = asyncio.Queue()
-                for tid, (cid, mid, txt, msg, ts) in state.task_queue_items.items():
-                    new_queue.put_nowait((cid, mid, txt, msg))
-                state.task_queue = new_queue
-
-        # Логирование удаления
-        if text:
-            logging.warning(
-                f"⚠️ Задача удалена: {text} ({chat_title}, {sender_info})",
-                extra={'chat_title': chat_title, 'sender_info': sender_info}
-            )
+    def update_chat_shares(self):
+        self.chat_share_list.clear()
+        chat_stats = {}
+        for queue in state.task_queues.values():
+            for chat_key, (queued, dispatched, oldest_wait, average_wait) in queue.chat_stats().items():
+                total = chat_stats.get(chat_key, (0, 0, 0, 0))
+                chat_stats[chat_key] = (total[0] + queued, total[1] + dispatched, max(total[2], oldest_wait), max(total[3], average_wait))
+        total_dispatched = sum(stats[1] for stats in chat_stats.values())
+        titles = {normalize_chat_id(chat_id): title for chat_id, title, _ in get_selected_chats()}
+        for chat_key, (queued, dispatched, oldest_wait, average_wait) in sorted(chat_stats.items(), key=lambda entry: -entry[1][2]):
+            share = dispatched * 100 // total_dispatched if total_dispatched else 0
+            title = titles.get(chat_key, str(chat_key))
+            item = QListWidgetItem(f"💬 {title}: ⏳ {queued} | ✅ {dispatched} ({share}%) | Ожидание: {int(oldest_wait)} сек (в среднем {int(average_wait)} сек)")
+            self.chat_share_list.addItem(item)
+
+    def format_task(self, job):
+        timestamp = datetime.fromtimestamp(job.created_at).strftime("%Y-%m-%d %H:%M:%S")
+        return f"{JOB_STAGE_LABELS[job.stage]} | {PLATFORM_LABELS[job.platform]}: {job.text} | Chat ID: {job.chat_id} | Добавлено: {timestamp}"
+
+    def add_task_row(self, job):
+        label = QLabel(self.format_task(job))
+        item_widget = QWidget()
+        item_layout = QHBoxLayout(item_widget)
+        front_button = QPushButton("⬆")
+        front_button.setFixedSize(30, 30)
+        front_button.setToolTip("Обработать следующей")
+        front_button.setEnabled(job.stage == 'queued')
+        front_button.clicked.connect(lambda _, job_id=job.id: self.move_task_to_front(job_id))
+        delete_button = QPushButton("Удалить")
+        delete_button.setFixedSize(80, 30)
+        delete_button.clicked.connect(lambda _, job_id=job.id: self.delete_task(job_id))
+        item_layout.addWidget(label)
+        item_layout.addStretch()
+        item_layout.addWidget(front_button)
+        item_layout.addWidget(delete_button)
+        list_item = QListWidgetItem(self.task_list)
+        list_item.setSizeHint(item_widget.sizeHint())
+        self.task_list.addItem(list_item)
+        self.task_list.setItemWidget(list_item, item_widget)
+        self.rows[job.id] = (list_item, label, front_button, job.stage)
 
+    def update_tasks(self):
+        self.update_chat_shares()
+        jobs = state.jobs.with_stage('running') + state.jobs.with_stage('queued') + state.jobs.with_stage('pending')
+        job_ids = {job.id for job in jobs}
+
+        stale_ids = [job_id for job_id in self.rows if job_id not in job_ids]
+        if stale_ids and len(stale_ids) == len(self.rows):
+            self.task_list.clear()
+            self.rows.clear()
+        else:
+            for job_id in stale_ids:
+                list_item = self.rows.pop(job_id)[0]
+                self.task_list.takeItem(self.task_list.row(list_item))
+
+        self.task_list.setUpdatesEnabled(False)
+        for job in jobs:
+            row = self.rows.get(job.id)
+            if row is None:
+                self.add_task_row(job)
+            elif row[3] != job.stage:
+                list_item, label, front_button, _ = row
+                label.setText(self.format_task(job))
+                front_button.setEnabled(job.stage == 'queued')
+                self.rows[job.id] = (list_item, label, front_button, job.stage)
+        self.task_list.setUpdatesEnabled(True)
+
+    def refresh(self):
         self.update_tasks()
         if self.parent():
             self.parent().update_task_indicators()
 
+    def delete_task(self, job_id):
+        job = cancel_job(job_id)
+        if job is None:
+            return
+
+        logging.warning(
+            f"⚠️ Задача удалена: {job.text} ({job.chat_title}, {job.sender_info})",
+            extra={'chat_title': job.chat_title, 'sender_info': job.sender_info}
+        )
+        self.refresh()
+
+    def move_task_to_front(self, job_id):
+        if not move_job_to_front(job_id):
+            return
+        job = state.jobs.get(job_id)
+        logging.info(
+            f"⬆ Задача перемещена в начало очереди: {job.text}",
+            extra={'chat_title': job.chat_title, 'sender_info': job.sender_info}
+        )
+        self.refresh()
+
+    def clear_queue(self):
+        removed = cancel_queued_jobs()
+        if removed:
+            logging.warning(f"⚠️ Очередь очищена, удалено задач: {removed}")
+        self.refresh()
+
 class DetailedStatsWindow(QMainWindow):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -5483,6 +6750,9 @@ class DetailedStatsWindow(QMainWindow):
         self.chat_list = QListWidget()
         self.log_list = QListWidget()
         self.log_list.setVisible(False)
+        self.prefilter_label = QLabel()
+        self.prefilter_label.setWordWrap(True)
+        layout.addWidget(self.prefilter_label)
         layout.addWidget(self.chat_list)
         layout.addWidget(self.log_list)
 
@@ -5505,6 +6775,12 @@ class DetailedStatsWindow(QMainWindow):
             item = QListWidgetItem(f"💬 {title}: ✅ {links_count} ❌ {errors_count}")
             item.setData(Qt.UserRole, title)
             self.chat_list.addItem(item)
+        drops = state.prefilter_drops
+        drop_parts = [f"{label}: {drops[step]}" for step, label in PREFILTER_STEP_LABELS.items() if drops[step]]
+        self.prefilter_label.setText(
+            f"📨 Передано в обработку: {drops['passed']} | Отсеяно сообщений: "
+            + (", ".join(drop_parts) if drop_parts else "0")
+        )
         if self.current_chat:
             self.update_logs()
 
@@ -5535,6 +6811,8 @@ class DetailedStatsWindow(QMainWindow):
                 self.log_list.addItem(item)
 
 def main():
+    # Пул процессов yt-dlp запускает дочерние процессы через spawn (Windows, сборка cx_Freeze)
+    multiprocessing.freeze_support()
     init_db()
     logging.info("Программа запущена")
     app = QApplication(sys.argv)
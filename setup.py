@@ -106,6 +106,8 @@ build_options = {
         ("help_content.json", "help_content.json"),
         ("icons", "icons"),
         ("bot.py", "bot.py"),
+        ("ytdlp_worker.py", "ytdlp_worker.py"),
+        ("video_links.py", "video_links.py"),
         ("requirements.txt", "requirements.txt"),
         (manifest_file, manifest_file),
         (byedpi_dir, "byedpi"),  # Добавляем папку byedpi
@@ -0,0 +1,86 @@
+# Микробенчмарк поиска ссылок: прежние циклы по VIDEO_URL_PATTERNS против одного прохода scan_video_links.
+# Запуск: python tools/bench_link_scan.py
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from video_links import VIDEO_URL_PATTERNS, scan_video_links
+
+MESSAGE_COUNT = 5000
+LINK_SHARE = 5  # ссылка в каждом пятом сообщении
+ROUNDS = 5
+
+WORDS = "привет как дела смотри вот это видео ну такое себе ахах ладно завтра созвонимся https://example.com/page".split()
+LINKS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://vm.tiktok.com/ZMabcdEF/",
+    "https://www.tiktok.com/@user.name/video/7234567890123456789",
+    "https://x.com/someone/status/1790000000000000000",
+    "https://www.instagram.com/reel/C7abcDEfgHi/",
+]
+
+
+def old_path(text):
+    # Как было раньше: платформа в фильтре, затем get_link_key и process_video_link — три отдельных прохода
+    platform = None
+    for name, pattern in VIDEO_URL_PATTERNS.items():
+        if pattern.search(text):
+            platform = name
+            break
+    if platform is None:
+        return None
+    key = None
+    for name, pattern in VIDEO_URL_PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            key = (name, match.group(2) if name == 'tiktok' else match.group(1))
+            break
+    for name, pattern in VIDEO_URL_PATTERNS.items():
+        if pattern.search(text):
+            break
+    return key
+
+
+def new_path(text):
+    links = scan_video_links(text)
+    return links[0][:2] if links else None
+
+
+def build_corpus():
+    random.seed(1)
+    corpus = []
+    for n in range(MESSAGE_COUNT):
+        text = " ".join(random.choice(WORDS) for _ in range(random.randint(3, 40)))
+        if n % LINK_SHARE == 0:
+            text += " " + random.choice(LINKS)
+        corpus.append(text)
+    return corpus
+
+
+def measure(func, corpus):
+    best = 0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for text in corpus:
+            func(text)
+        best = max(best, len(corpus) / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    corpus = build_corpus()
+    # В сообщениях с одной ссылкой оба пути должны находить одно и то же
+    for text in corpus:
+        assert old_path(text) == new_path(text), text
+    link_corpus = [text for text in corpus if new_path(text)]
+    for title, messages in (("все сообщения", corpus), ("сообщения со ссылкой", link_corpus)):
+        print(f"{title} ({len(messages)}):")
+        for func in (old_path, new_path):
+            print(f"  {func.__name__}: {measure(func, messages):,.0f} сообщ./с")
+
+
+if __name__ == '__main__':
+    main()
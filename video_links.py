@@ -0,0 +1,29 @@
+# Поиск ссылок на видео в тексте сообщения.
+# Модуль без побочных эффектов при импорте: его используют bot.py и tools/bench_link_scan.py
+import re
+
+VIDEO_URL_PATTERNS = {
+    'youtube': re.compile(r'(?:https?://)?(?:www\.)?(?:youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/)([\w-]{11})'),
+    'instagram': re.compile(r'(?:https?://)?(?:www\.)?instagram\.com/reel[s]?/([\w-]+)'),
+    'tiktok': re.compile(r'(?:https?://)?(?:[\w-]+\.)?tiktok\.com/(?:@([\w\.-]+)/video/|v/)?([\w-]+)'),
+    'twitter': re.compile(r'(?:https?://)?(?:www\.)?(?:twitter\.com|x\.com)/[\w-]+/status/(\d+)')
+}
+# Все шаблоны одним выражением: текст просматривается один раз, платформу даёт имя сработавшей группы
+VIDEO_LINK_SCANNER = re.compile('|'.join(f'(?P<{name}>{pattern.pattern})' for name, pattern in VIDEO_URL_PATTERNS.items()))
+# id видео — последняя группа каждого шаблона (у TikTok перед ним необязательное имя пользователя)
+VIDEO_LINK_ID_GROUPS = {name: VIDEO_LINK_SCANNER.groupindex[name] + pattern.groups for name, pattern in VIDEO_URL_PATTERNS.items()}
+# Без одной из этих подстрок ссылки точно нет — обычные сообщения отсеиваются без регулярного выражения
+VIDEO_LINK_MARKERS = ('youtu', 'instagram.com', 'tiktok.com', 'twitter.com', 'x.com')
+
+
+def scan_video_links(text):
+    # Все ссылки на видео в тексте за один проход: ((платформа, id видео, (начало, конец)), ...) в порядке появления
+    for marker in VIDEO_LINK_MARKERS:
+        if marker in text:
+            break
+    else:
+        return ()
+    return tuple(
+        (match.lastgroup, match.group(VIDEO_LINK_ID_GROUPS[match.lastgroup]), match.span())
+        for match in VIDEO_LINK_SCANNER.finditer(text)
+    )
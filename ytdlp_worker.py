@@ -0,0 +1,40 @@
+# Запуск yt-dlp в потоке или дочернем процессе пула bot.py.
+# Модуль без побочных эффектов при импорте: дочерним процессам нужен только он и yt_dlp
+import yt_dlp
+
+
+class YtdlpDownloadError(Exception):
+    # DownloadError yt-dlp хранит traceback и не переживает передачу из дочернего процесса,
+    # поэтому наружу отдаются только текст ошибки и признак ожидаемой ошибки (видео удалено, приватное и т. п.)
+    def __init__(self, message, expected):
+        super().__init__(message, expected)
+        self.message = message
+        self.expected = expected
+
+    def __str__(self):
+        return self.message
+
+
+def run_ytdlp(url, ydl_opts, download, progress_sink=None, info=None):
+    # Выполняется в потоке или дочернем процессе, поэтому работает только с сериализуемыми данными
+    opts = dict(ydl_opts)
+    if progress_sink is not None:
+        opts['progress_hooks'] = [lambda d: progress_sink.put({
+            'status': d.get('status'),
+            'downloaded_bytes': d.get('downloaded_bytes', 0),
+            'total_bytes': d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0),
+        })]
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if info is not None:
+                # Метаданные уже извлечены: скачиваем по ним без повторного разбора страницы и форматов
+                info = ydl.process_ie_result(info, download=download)
+            else:
+                info = ydl.extract_info(url, download=download)
+            if not info:
+                return None, None
+            filename = ydl.prepare_filename(info) if download else None
+            return ydl.sanitize_info(info), filename
+    except yt_dlp.utils.DownloadError as e:
+        expected = bool(getattr((e.exc_info or (None, None))[1], 'expected', False))
+        raise YtdlpDownloadError(str(e), expected) from None